@@ -1,13 +1,50 @@
-import os, csv, sys, re, json, math
+import os, csv, sys, re, json, math, random, threading, time, queue
+import gzip, glob, copy, hashlib, bisect, codecs, cProfile, pstats, tracemalloc, fnmatch
+from contextlib import contextmanager, nullcontext
 import toml
 from itertools import accumulate, chain
-from datetime import datetime
+from collections import deque, defaultdict, Counter
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from datetime import datetime, timedelta, timezone
+from urllib.parse import quote
+from email.utils import parsedate_to_datetime
 import requests
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
 
 """ 
 Class used to query IR and export output:
 - RepositoryQuery
 
+Class used to filter IR documents on fields:
+- FieldProjector
+
+Class used to search collection data in memory:
+- FieldIndex
+
+Class used to count facets of records as they stream:
+- FacetAggregator
+
+Class used to plan pages of adaptive size:
+- PagePlanner
+
+Class used to split harvests into modified date windows:
+- DateWindowPlanner
+
+Class used to write records pushed from other threads:
+- RecordQueueWriter
+
+Class used to checkpoint harvests to disk:
+- HarvestCheckpoint
+
+Classes used to make HTTP requests to the IR API:
+- Transport
+- RequestScheduler
+- ResponseCache
+
+Class used to measure harvests and exports:
+- HarvestMetrics
+
 """
 
 
@@ -41,20 +78,92 @@ class RepositoryQuery():
                 "Cooperative Science Centers": "24914"
             }
 
-    def __init__(self, fields):
+    def __init__(self, fields, max_workers=1,
+        pool_maxsize=None, retries=5, backoff_factor=0.5,
+        timeout=(10, 300), cache_dir=None, cache_ttl=3600,
+        cache_max_bytes=2 * 1024 ** 3, mirror=None, projection='auto',
+        page_size=5000, adaptive_paging=False, stream_parse=False,
+        profile_dir=None, checkpoint_dir=None, max_rps=None, shard_rows=None):
 
         self.api_url =  "https://repository.library.noaa.gov/fedora/export/view/collection/"
         self.fields = fields
         self.pid = ''
+        # optional FieldIndex used by search methods. see build_index
+        self.index = None
         self.collection_data = []
         self.date_params = None
+        # number of pages fetched concurrently. 1 keeps the serial behavior
+        self.max_workers = max_workers
+        # optional mirror.RepositoryMirror used by search methods
+        self.mirror = mirror
+        # ask the API for configured fields only ('fl' param). 'auto' 
+        # checks once per api url whether the API supports it, on first
+        # use (see use_projection), True/False forces it.
+        self.projection = projection
+        # bytes received per filtering mode. see request_stats
+        self.projection_bytes = {'upstream': 0, 'local': 0}
+        self._lock = threading.Lock()
+        # rows per page. with adaptive_paging, page_size is only the
+        # first page size, later ones are sized by a PagePlanner
+        self.page_size = page_size
+        self.adaptive_paging = adaptive_paging
+        # decode page bodies as they download, keeping configured 
+        # fields only, instead of loading whole pages with .json()
+        self.stream_parse = stream_parse
+        # pages of harvests are saved to '<checkpoint_dir>/<pid>', so 
+        # an interrupted harvest resumes from its first missing page.
+        # see HarvestCheckpoint. adaptive_paging is ignored when set
+        self.checkpoint_dir = checkpoint_dir
+        # with shard_rows, harvests are split in fgs.lastModifiedDate
+        # windows of about shard_rows records instead of deep offsets.
+        # see iter_sharded_pages
+        self.shard_rows = shard_rows
+        # optional on-disk cache of API responses
+        if cache_dir is None:
+            cache = None
+        else:
+            cache = ResponseCache(cache_dir, cache_ttl, cache_max_bytes)
+        # per-request and per-stage measurements. with profile_dir, 
+        # stages are also profiled (see HarvestMetrics.write_profile)
+        self.metrics = HarvestMetrics(profile_dir)
+        # pooled session shared by every request made by this instance.
+        # max_workers caps requests in flight across collections
+        # exported at the same time (see export_collections). below
+        # that cap, concurrency adapts to the server and max_rps
+        # caps requests per second (see RequestScheduler)
+        self.transport = Transport(
+            pool_maxsize=pool_maxsize or max(10, max_workers),
+            retries=retries, backoff_factor=backoff_factor,
+            timeout=timeout, cache=cache, max_concurrency=max_workers,
+            metrics=self.metrics, max_rps=max_rps)
+
+    @property
+    def collection_data(self):
+        """
+        List of IR records pulled (and filtered) by the instance.
+        """
+        return self._collection_data
+
+
+    @collection_data.setter
+    def collection_data(self, records):
+        self._collection_data = records
+        if self.index is not None:
+            self.index.set_records(records)
 
-    def add_date_filtering(self):
+
+    def add_date_filtering(self, date_dict=None):
         """
         Method adds date params dictionary to empty date params 
+
+        Parameters:
+            date_dict: dict with 'from' and 'until' keys. date params
+            of the toml file passed on the command line are used if None.
         """
 
-        self.date_params = create_date_filter_params(data['date_params'])
+        if date_dict is None:
+            date_dict = data['date_params']
+        self.date_params = create_date_filter_params(date_dict)
 
         
     def get_single_collection(self,pid):
@@ -73,14 +182,10 @@ class RepositoryQuery():
             Response header and Documents from an IR collection in JSON.
         """
         
-        self.pid = str(pid)
-
-        check_pid(self.pid_dict, self.pid)
-        row_total = get_row_total(self.api_url, self.pid, self.date_params) 
-        api_url_info = iterate_rows(self.api_url, self.pid, row_total, self.date_params)
-
-        # call concat_json function
-        self.collection_data = concat_json(api_url_info)
+        # pages of page_size rows, adaptive, checkpointed or
+        # sharded as set during instantiation
+        self.collection_data = list(chain.from_iterable(
+            self.iter_collection_pages(pid, project=False)))
 
 
     def get_all_items(self):
@@ -99,13 +204,99 @@ class RepositoryQuery():
         """
 
         all_ir_json = 'noaa'
-        row_total = get_row_total(self.api_url, all_ir_json, self.date_params)
-        api_url_info = iterate_rows(self.api_url, all_ir_json, row_total, self.date_params)
+        # pages of page_size rows, adaptive, checkpointed or
+        # sharded as set during instantiation
+        self.collection_data = list(chain.from_iterable(
+            self.iter_collection_pages(all_ir_json, project=False)))
+
+
+    def checkpoint(self, pid, row_total, row_num=5000, field_list=None,
+        fields=None):
+        """
+        Open the checkpoint of a collection harvest, if checkpoint_dir
+        was passed during instantiation. See HarvestCheckpoint.
 
-        # call concat_json function
-        self.collection_data = concat_json(api_url_info)
+        Returns:
+            HarvestCheckpoint, None without checkpoint_dir.
+        """
+
+        if self.checkpoint_dir is None:
+            return None
+
+        checkpoint = HarvestCheckpoint(os.path.join(self.checkpoint_dir, str(pid)))
+        checkpoint.open({
+            'query': api_url_base_constructor(self.api_url, pid) 
+                + build_extra_params(self.date_params, field_list),
+            'date_params': self.date_params,
+            'row_num': row_num,
+            'fields': fields
+            }, row_total)
+        return checkpoint
         
 
+    def request_stats(self):
+        """
+        Request statistics of the instance transport.
+
+        Returns:
+            dict with request, retry, error and reused 
+            connection counts, bytes received, and bytes received
+            while fields were filtered upstream ('bytes_upstream')
+            or locally ('bytes_local').
+        """
+
+        stats = self.transport.get_stats()
+        for mode, received in self.projection_bytes.items():
+            stats[f'bytes_{mode}'] = received
+        return stats
+
+
+    def add_metrics_hook(self, hook):
+        """
+        Register a callback receiving every metrics event (dict):
+        - {'event': 'request', 'url', 'status', 'seconds', 'bytes'}
+        - {'event': 'stage', 'stage', 'seconds', 'peak_memory'}
+        - {'event': 'summary', ...}: see HarvestMetrics.summary, sent
+        at the end of each export.
+
+        Parameters:
+            hook: callable taking an event dict. called from 
+            worker threads as well as the main thread.
+        """
+
+        self.metrics.add_hook(hook)
+
+
+    def use_projection(self):
+        """
+        Check whether the export endpoint supports field 
+        selection with the 'fl' param. Checked once per api url
+        when projection is 'auto', by requesting a single
+        record with only the PID field. The answer is shared 
+        by every instance (see projection_support).
+
+        Returns:
+            True if fields are filtered upstream.
+        """
+
+        if self.projection == 'auto':
+            with projection_lock:
+                supported = projection_support.get(self.api_url)
+                if supported is None:
+                    url = f"{api_url_base_constructor(self.api_url, 'noaa')}?rows=1&fl=PID"
+                    try:
+                        docs = get_page_docs(url, self.transport)
+                    except Exception:
+                        docs = None
+                    supported = bool(docs) and set(docs[0]) <= {'PID'}
+                    # failed probes are tried again by later instances
+                    if docs is not None:
+                        projection_support[self.api_url] = supported
+            self.projection = supported
+
+        return bool(self.projection)
+
+
     def filter_on_fields(self):
         """
         Filters JSON based on fields list passed into function.        
@@ -114,13 +305,8 @@ class RepositoryQuery():
             Documents of from an IR collection in JSON
         """
 
-        filtered_data = []
-
-        for doc in self.collection_data:
-            filtered_data.append(
-                field_iterator(doc, self.fields))
-             
-        self.collection_data = filtered_data
+        self.collection_data = compile_fields(self.fields).project_page(
+            self.collection_data)
 
 
     def convert_multivals_to_one(self, field, delimiter='~'):
@@ -129,7 +315,8 @@ class RepositoryQuery():
         generating a new row, carrying over associated value to 
         newly created row.
 
-        Default delimiter is a tilda symbol.
+        Default delimiter is a tilda symbol. See explode_fields
+        to explode several fields and keep other columns.
 
         Parameters:
             field: collection data field
@@ -139,33 +326,19 @@ class RepositoryQuery():
             with new values.
         """
 
-        data = []
-
-        for item in self.collection_data:
-            if ';' in item[field]:
-                for multi_item in item[field].split(delimiter):
-                    data.append({
-                        'PID': item['PID'],
-                        field : multi_item
-                        })
-            else:
-                data.append({
-                        'PID': item['PID'],
-                        field: item[field]
-                        })
-
-        # remove entries where fields equal ''    
-        data = [x for x in data if x[field] != '']
-
-        self.collection_data = data
+        self.collection_data = [{'PID': row['PID'], field: row['value']}
+            for row in explode_fields(self.collection_data, [field], 
+                ['PID'], delimiter)]
 
 
     def search_field(self, field, search_value):
         """ 
         Search on collection data. 
 
-        Collection data must already be pull and stored in 
-        collection data instance variable. Exception will be thrown if not.
+        If a mirror was passed during instantiation, the search
+        runs against the mirror database. Otherwise collection data
+        must already be pull and stored in collection data instance
+        variable. Exception will be thrown if not.
 
         Simple search is performed on selected field. 
         Search is converted to lower lower as is field to be searched on.
@@ -177,10 +350,16 @@ class RepositoryQuery():
         Returns:
             list of dicts.
         """
+
+        if self.mirror is not None:
+            return self.mirror.search_field(field, search_value)
         
         if len(self.collection_data) == 0:
             raise Exception('No Collection data present. Make sure to pull data (single collection or entire dataset)')
 
+        if self.index is not None:
+            return self.index.search({field: search_value})
+
         result_list = []
 
         for record in self.collection_data:
@@ -191,304 +370,3672 @@ class RepositoryQuery():
                 raise Exception('field not present. Check your RepositoryQuery instance fields')
 
         return result_list     
-    
 
-    def export_single_collection(self,
-        pid, filetype='csv',export_path='.',
-        col_fname=col_fname):
-        
+
+    def search_fields(self, criteria, match='all'):
         """
-        Export single repository collection data to CSV or JSON.
+        Search on several fields of collection data (or of the 
+        mirror database if a mirror was passed during instantiation).
+
+        Same case insensitive search as search_field.
 
         Parameters:
-            pid: collection pid. can also be 'noaa' if entire colleciton.
-            filetype: 'csv' by default arg. 'json' as optional output.
-            export_path: '.', or current path is default arg.
-            col_fname: filename. 'noaa_collection_YYYY_MM_DD' is default arg.
+            criteria: dict of field: search_value
+            match: 'all' if every criteria must match, 'any' if
+            at least one must.
 
         Returns:
-            CSV or JSON of a single IR collection.
+            list of dicts.
         """
-        # creates directory if it doesn't exists
-        make_dir(export_path)
-        
-        # repository_query.get_single_collection_json(collection_pid)
-        self.get_single_collection(pid)
-        self.filter_on_fields()
 
-        collection_full_path = os.path.join(export_path, f"{col_fname}.{filetype}")
-        print(collection_full_path)
+        if match not in ('all', 'any'):
+            raise Exception(f"{match} is not a valid match. Use 'all' or 'any'")
 
-        #export data
-        # as CSV
-        if filetype == 'csv':
-            delimiter = '\t'
-            write_dict_list_to_csv(self.collection_data,
-                collection_full_path,
-                delimiter, self.fields)
-        
-        # as JSON
-        elif filetype == 'json':
-            with open(collection_full_path, 'w') as f:
-                json.dump(self.collection_data,
-                    f,indent=4)
-                
-        else:
-            print('filetype not accepted')
+        if self.mirror is not None:
+            return self.mirror.search_fields(criteria, match)
 
-    
-    def export_all_items(self,
-        filetype='csv',export_path='.',
-        col_fname=col_fname):
+        if len(self.collection_data) == 0:
+            raise Exception('No Collection data present. Make sure to pull data (single collection or entire dataset)')
+
+        if self.index is not None:
+            return self.index.search(criteria, match)
+
+        combine = all if match == 'all' else any
+        criteria = {field: value.lower() for field, value in criteria.items()}
+
+        result_list = []
+
+        for record in self.collection_data:
+            try:
+                if combine(value in record[field].lower() 
+                    for field, value in criteria.items()):
+                    result_list.append(record)
+            except KeyError:
+                raise Exception('field not present. Check your RepositoryQuery instance fields')
+
+        return result_list
+
+
+    def build_index(self, fields=None):
         """
-        Exports all repository items data to CSV or JSON.
+        Build an in-memory FieldIndex over collection data, used by
+        search_field and search_fields instead of a scan of every record.
+
+        The index follows collection data: records appended to it are
+        indexed on the next search, and the index is rebuilt when
+        collection data is replaced (e.g. by filter_on_fields).
 
         Parameters:
-            pid: collection pid. can also be 'noaa' if entire colleciton.
-            filetype: 'csv' by default arg. 'json' as optional output.
-            export_path: '.', or current path is default arg.
-            col_fname: filename. 'noaa_collection_YYYY_MM_DD' is default arg.
+            fields: fields to index. instance fields are indexed if None.
 
         Returns:
-            CSV or JSON of all items.
+            FieldIndex
         """
 
-        # creates directory if it doesn't exists
-        make_dir(export_path)
-        
-        # repository_query.get_all_items
-        self.get_all_items()
-        self.filter_on_fields()
+        self.index = FieldIndex(fields or self.fields)
+        self.index.set_records(self.collection_data)
+        self.index.update()
+        return self.index
 
-        collection_full_path = os.path.join(export_path, f"{col_fname}.{filetype}")
-        print(collection_full_path)
 
-        #export data
-        # as CSV
-        if filetype == 'csv':
-            delimiter = '\t'
-            write_dict_list_to_csv(self.collection_data,
-                collection_full_path,
-                delimiter, self.fields)
-        
-        # as JSON
-        elif filetype == 'json':
-            with open(collection_full_path, 'w') as f:
-                json.dump(self.collection_data,
-                    f,indent=4)
-                
-        else:
-            print('filetype not accepted')
+    def add_records(self, records):
+        """
+        Append records to collection data. Records are indexed
+        if an index was built.
 
-    ############################
-    ####### Functions ##########
-    ############################
+        Parameters:
+            records: list (or iterable) of dicts.
+        """
 
-def field_iterator(json_data, fields):
-    """
-    Helper function. 
+        self.collection_data.extend(records)
+        if self.index is not None:
+            self.index.update()
 
-    Return dict
-    """
 
-    data_dict = {}
+    def mirror_collection(self, pid):
+        """
+        Pull a collection into the mirror database passed during
+        instantiation. Raw documents are written page by page, 
+        records already mirrored are replaced. Once the whole 
+        collection is pulled, its PIDs are stored as its members
+        (see RepositoryMirror.members).
 
-    delimiter = '~'
-    for field in fields:
-        if json_data.get(field) is None:
-            data_dict.update({field: ''})
-        elif isinstance(json_data.get(field), list): 
-            # delimter
-            data_dict.update({field: clean_text(delimiter.join(json_data.get(field)))})
-        else:
-            data_dict.update({field: clean_text(json_data.get(field))})
+        Parameters:
+            pid: collection pid. can also be 'noaa' if entire colleciton.
 
-    return data_dict
+        Returns:
+            number of records written.
+        """
 
+        if self.mirror is None:
+            raise Exception('No mirror present. Pass a RepositoryMirror during instantiation')
 
-def make_request(url):
-    """
-    Make request. Check for 200 status code. If not exit
-    script with sys.exit.  
-    
-    Parameters:
-        url: api url string.
-    
-    Returns:
-        Returns response, if not returns
-        message and quit program.
-    """
+        written = 0
+        members = set()
+        # mirror keeps every field of raw documents
+        for docs in self.iter_collection_pages(pid, project=False):
+            written += self.mirror.upsert(docs)
+            members.update(str(doc['PID']) for doc in docs)
+        self.mirror.set_members(pid, members)
+        return written
 
-    r = requests.get(url)
-    if r.status_code != 200:
-        return 'status code did not return 200'
-    return r
 
+    def iter_collection_pages(self, pid, project=True, fields=None):
+        """
+        Stream raw documents of a collection, one page at a time.
 
-def get_row_total(api_url, pid, date_params):
-    """
-    Get row total from collection. 
+        Parameters:
+            pid: collection pid. can also be 'noaa' if entire colleciton.
+            project: if True and the API supports it (see 
+            use_projection), documents only contain instance fields.
+            fields: fields projected instead of instance fields.
 
-    Parameters:
-        api_url: api url string
-        pid: collection pid. can also be 'noaa' if entire colleciton.
-        date_parameters: string formatted as 
-            'from=MMMM-YY-DDT00:00:00Z&until=MMMM-YY-DDT00:00:00Z'
+        Returns:
+            generator of lists of IR records (one list per page).
+        """
 
-    Returns row total for each collection, 
-    including entire NOAA IR collection.
-    """
+        # local pid, collections may be pulled from several threads
+        pid = str(pid)
+        self.pid = pid
+        fields = self.fields if fields is None else fields
 
-    # conditional is based on whether the option
-    # was selected to use class method of 'add filter'
-    if date_params is None:
-        r = requests.get(f'{api_url}{pid}')
-    else:
-        r = requests.get(f'{api_url}{pid}?{date_params}')
+        check_pid(self.pid_dict, pid)
 
-    if r.status_code != 200:
-        return 'status code did not return 200'
-    data = r.json()
-    return data['response']['numFound']
+        # wildcard fields are matched locally, see FieldProjector
+        field_list = None
+        if (project and not compile_fields(fields).patterns 
+            and self.use_projection()):
+            field_list = fields
 
+        # fields kept by the streaming parser. None keeps every field
+        stream_fields = fields if project else None
 
-def iterate_rows(api_url, col_pid, row_total, date_params, row_num=5000): 
-    """
-    If total number of rows is less than 
-    chunk val a list of URLS is generated with 
-    a num appended with a query string
-    """
+        # counts the bytes of this harvest only, collections
+        # may be pulled from several threads at once
+        transport = self.transport.child()
+        if self.shard_rows:
+            pages = self.iter_sharded_pages(pid, field_list, stream_fields, transport)
+        else:
+            pages = self.iter_offset_pages(pid, field_list, stream_fields, transport)
 
-    url_base = api_url_base_constructor(api_url, col_pid)
+        mode = 'local' if field_list is None else 'upstream'
+        try:
+            yield from pages
+        finally:
+            with self._lock:
+                self.projection_bytes[mode] += transport.stats.get('bytes', 0)
 
-    if row_total < row_num:
-        # conditional is based on whether the option
-        # was selected to use class method of 'add filter'
-        return f'{url_base}?rows={row_total}&{date_params}'
-    else:
-        chunk_array = split_equal(row_total, row_num)
-        # insert 0 at beginning of list
-        chunk_array.insert(0,0) 
-        cumsum_chunk_array = list(accumulate(chunk_array))
 
-        chunk_link_array = []
+    def iter_offset_pages(self, pid, field_list=None, stream_fields=None,
+        transport=None):
+        """
+        Harvest a collection with start/rows offsets: adaptive pages
+        (see PagePlanner), or fixed pages, checkpointed if
+        checkpoint_dir is set. Requests are sent with transport,
+        the instance transport if None.
 
-        for chunk in cumsum_chunk_array:
-            if chunk != row_total:
-                if date_params is None:
-                    # chunk url conditional is based on whether the option
-                    # was selected to use class method of 'add filter'
-                    chunk_url = f'{url_base}?rows={str(row_num)}&start={str(chunk)}'
-                    chunk_link_array.append(chunk_url)
-                else:
-                    chunk_url = f'{url_base}&rows={str(row_num)}&start={str(chunk)}'
-                    chunk_link_array.append(chunk_url)
-                continue
+        Returns:
+            generator of lists of IR records (one list per page).
+        """
 
-        return chunk_link_array
+        transport = transport or self.transport
+        with self.metrics.stage('count'):
+            row_total = get_row_total(self.api_url, pid, self.date_params,
+                transport)
 
-    
-def split_equal(total, row_num):
-    """
-    Helper function for iterate_rows function
-    """
-    li = [row_num] * math.floor((total / row_num))
-    return li
+        if self.adaptive_paging and self.checkpoint_dir is None:
+            pages = iter_adaptive_pages(
+                api_url_base_constructor(self.api_url, pid),
+                build_extra_params(self.date_params, field_list),
+                PagePlanner(row_total, self.page_size),
+                self.max_workers, transport,
+                stream=self.stream_parse, fields=stream_fields)
+        else:
+            api_url_info = iterate_rows(self.api_url, pid, row_total,
+                self.date_params, self.page_size, field_list)
+            checkpoint = self.checkpoint(pid, row_total, self.page_size,
+                field_list, stream_fields)
+            if checkpoint is None:
+                pages = iter_pages(api_url_info, self.max_workers, transport,
+                    stream=self.stream_parse, fields=stream_fields)
+            else:
+                pages = iter_checkpointed_pages(api_url_info, checkpoint,
+                    self.page_size, self.max_workers, transport,
+                    stream=self.stream_parse, fields=stream_fields)
 
+        return pages
 
-def concat_json(api_url_info):
-    """
-    Function utilized to handle multiple or single api URL requests.
 
-    If multiple API URL requests are occur, requests are made
-    using list comprehensions resulting in lists of dicts. Lists
-    are combined using itertools chain. 
+    def iter_sharded_pages(self, pid, field_list=None, fields=None,
+        transport=None):
+        """
+        Harvest a collection in fgs.lastModifiedDate windows.
 
-    If single API request is made, only list of dicts is returned.
+        A DateWindowPlanner splits the harvest (date params if set,
+        else everything modified until now) into windows of about
+        shard_rows records, using numFound probes. Pages of every
+        window are requested in parallel, with shallow offsets, and
+        yielded as they arrive. Windows only share the second one ends
+        and the next starts, and a final catch-up window pulls records
+        modified since the harvest started. Records are only yielded
+        if their PID wasn't harvested yet, so records of those shared
+        seconds or modified during the harvest are yielded once. Only
+        the set of harvested PIDs is held in memory. Records modified
+        during the harvest keep the version read first.
 
-    Returns:
-        list of IR records. Response header is removed in the process. 
-        Neccessary for concating JSON.  
-    """
-    
-    # if api_url_info contains multiple links are present
-    if isinstance(api_url_info, list):
-        r = [make_request(url) for url in api_url_info]
-        data = [x.json() for x in r]
-        docs = [x['response']['docs'] for x in data]
-        #use itertools chain to concat lists together
-        docs = list(chain(*docs))
-    
-    # if a single link is present
-    elif isinstance(api_url_info, str):
-        r = make_request(api_url_info)
-        data = r.json()
-        docs = data['response']['docs']
+        Parameters:
+            pid: collection pid. can also be 'noaa' if entire colleciton.
+            field_list: fields asked to the API ('fl' param). None for all.
+            fields: with stream_parse, fields kept in each document.
+            transport: Transport of requests. instance transport if None.
 
-    return docs
+        Returns:
+            generator of lists of IR records (one list per page).
+        """
 
+        transport = transport or self.transport
+        # needed to deduplicate, dropped afterwards if not asked for
+        drop_pid = any(projected is not None and 'PID' not in projected
+            for projected in (field_list, fields))
+        if field_list is not None and 'PID' not in field_list:
+            field_list = list(field_list) + ['PID']
+        if fields is not None and 'PID' not in fields:
+            fields = list(fields) + ['PID']
 
-def check_pid(collection_info, pid):
-    """
-    Checks to see if pid is a valid pid repo collection pid.
+        planner = DateWindowPlanner(self.api_url, pid, self.shard_rows,
+            self.max_workers, transport)
+        start, end = date_param_range(self.date_params)
+        # until is fixed now, so later changes fall in the catch-up window
+        harvest_end = end or datetime.now(timezone.utc).strftime(timestamp_format)
+        with self.metrics.stage('count'):
+            windows = planner.plan(start, harvest_end)
+        self.windows = windows
 
-    Parameters:
-        pid: sting value
+        seen = set()
+        def new_docs(docs):
+            docs = [doc for doc in docs if str(doc.get('PID')) not in seen]
+            seen.update(str(doc.get('PID')) for doc in docs)
+            if drop_pid:
+                for doc in docs:
+                    doc.pop('PID', None)
+            return docs
 
-    Returns:
-        Error message and exit program is value isn't valid; pid 
-        passed in if value is valid.
-    """
-    for collection_pid in collection_info.values():
-        if pid == collection_pid:
-            return pid
-    return f'{pid} is not a valid pid'
+        urls = []
+        for window_start, window_end, count in windows:
+            urls.extend(window_urls(self.api_url, pid, window_start, window_end,
+                count, self.page_size, field_list))
+        for docs in iter_pages(urls, self.max_workers, transport,
+            stream=self.stream_parse, fields=fields):
+            docs = new_docs(docs)
+            if docs:
+                yield docs
 
+        # records modified during the harvest
+        if end is None:
+            # starts at the second the last window ends, see DateWindowPlanner
+            catch_up_start = harvest_end
+            catch_up_end = datetime.now(timezone.utc).strftime(timestamp_format)
+            count = planner.count(catch_up_start, catch_up_end)
+            for docs in iter_pages(window_urls(self.api_url, pid, catch_up_start,
+                catch_up_end, count, self.page_size, field_list),
+                self.max_workers, transport,
+                stream=self.stream_parse, fields=fields):
+                docs = new_docs(docs)
+                if docs:
+                    yield docs
 
-def make_dir(filepath):
-    """
-    Creates directory in current working
-    directory if it doesn't exists
 
-    Paramaters:
-        filepath: filepath
-    
-    """
-    if os.path.exists(filepath) == False:
-        os.mkdir(filepath)
+    def iter_records(self, pid, flatten=True):
+        """
+        Stream records of a collection, page by page.
 
+        Records are filtered on fields as each page arrives, so only
+        about max_workers pages are held in memory at once, no matter
+        the size of the collection. collection_data is left untouched.
 
-def clean_text(text):
-    """
-    Clean text data.
-    """
-    text = text.replace('\n', '').replace('\r','')
-    return text
+        Parameters:
+            pid: collection pid. can also be 'noaa' if entire colleciton.
+            flatten: if True, values are cleaned strings and multivalued
+            fields joined with '~' (see field_iterator). if False, API
+            values are kept as is (lists for multivalued fields, None 
+            for missing fields).
 
+        Returns:
+            generator of filtered records (dicts).
+        """
 
-def write_dict_list_to_csv(dict_li,file_path, delimiter, fieldnames):
-    """
-    Write Python dict list to CSV
+        projector = compile_fields(self.fields)
+        for docs in self.iter_collection_pages(pid):
+            with self.metrics.stage('project'):
+                records = projector.project_page(docs, flatten)
+            self.metrics.add_records(len(records))
+            yield from records
 
-    Parameters:
-        dict_li: Python list of dictionaries
-        file_path: abs or relative file path. use to save CSV
-        delimiter: choose type of delimiter
-        fieldnames: function utilizes csv.DictWriter. Currently
-        written to require header.
-    """
 
-    with open(file_path, 'w',
-        newline='', encoding='utf-8') as fh:
-        
-        # list of dictionaries written to CSV
-        csvfile = csv.DictWriter(fh,
+    def aggregate(self, pid, aggregator):
+        """
+        Count the records of a collection with a FacetAggregator,
+        without exporting them. Records are streamed, see iter_records.
+
+        Parameters:
+            pid: collection pid. can also be 'noaa' if entire colleciton.
+            aggregator: FacetAggregator. its fields must be instance fields.
+
+        Returns:
+            aggregator
+        """
+
+        return aggregator.update(self.iter_records(pid))
+
+
+    def iter_exploded(self, pid, fields, keep=('PID',)):
+        """
+        Stream a collection in long format: one row per value of
+        each multivalued field, e.g. for subject or series facets.
+        See explode_fields.
+
+        Parameters:
+            pid: collection pid. can also be 'noaa' if entire colleciton.
+            fields: multivalued fields exploded, in one pass.
+            keep: fields copied to every row of a record (cleaned
+            strings, see FieldProjector.project).
+
+        Returns:
+            generator of dicts (keep fields, 'field', 'value')
+        """
+
+        for field in chain(fields, keep):
+            if field not in self.fields:
+                raise Exception(f'{field} field not present. Check your RepositoryQuery instance fields')
+
+        kept = compile_fields(keep)
+        for docs in self.iter_collection_pages(pid):
+            with self.metrics.stage('project'):
+                # raw values, no join and split of multivalued fields
+                records = [dict(kept.project(doc), 
+                    **{field: doc.get(field) for field in fields}) for doc in docs]
+                rows = list(explode_fields(records, fields, keep))
+            self.metrics.add_records(len(records))
+            yield from rows
+
+
+    def sync_collection(self,
+        pid, filetype='csv', export_path='.',
+        col_fname=col_fname, state_fname='sync_state.json',
+        overlap=timedelta(hours=1), compresslevel=6):
+        """
+        Incremental export of a repository collection.
+
+        A high-water mark is stored per collection pid in a state file.
+        On the first run the whole collection is pulled. On later runs
+        only records modified (fgs.lastModifiedDate) since the high-water
+        mark are pulled and merged by PID into the previous snapshot:
+        changed records are replaced and new records added. Records
+        deleted from the repository are not removed from the snapshot.
+
+        The snapshot ('snapshot_<pid>.json') and state file are kept in
+        export_path. Date params set with add_date_filtering are 
+        ignored during the sync. 'PID' must be one of the fields.
+
+        Parameters:
+            pid: collection pid. can also be 'noaa' if entire colleciton.
+            filetype: 'csv' by default arg. 'json' as optional output.
+            export_path: '.', or current path is default arg.
+            col_fname: filename. 'noaa_collection_YYYY_MM_DD' is default arg.
+            state_fname: name of the high-water mark state file.
+            overlap: timedelta substracted from the high-water mark, to
+            allow for clock differences with the repository server.
+            compresslevel: gzip level (1-9) of 'ndjson.gz' output.
+
+        Returns:
+            number of records pulled during the sync.
+        """
+
+        if 'PID' not in self.fields:
+            raise Exception('PID field is required to merge records. Check your RepositoryQuery instance fields')
+
+        if filetype not in export_filetypes:
+            print('filetype not accepted')
+            return
+
+        pid = str(pid)
+        make_dir(export_path)
+
+        state_path = os.path.join(export_path, state_fname)
+        snapshot_path = os.path.join(export_path, f'snapshot_{pid}.json')
+        state = read_json_file(state_path) if os.path.exists(state_path) else {}
+
+        until = datetime.now(timezone.utc)
+        snapshot = {}
+        date_params = self.date_params
+
+        if pid in state and os.path.exists(snapshot_path):
+            high_water_mark = datetime.strptime(
+                state[pid]['high_water_mark'], timestamp_format)
+            self.date_params = create_date_filter_params({
+                'from': (high_water_mark - overlap).strftime(timestamp_format),
+                'until': until.strftime(timestamp_format)
+                })
+            for record in read_json_file(snapshot_path):
+                snapshot[record['PID']] = record
+        else:
+            self.date_params = None
+
+        pulled = 0
+        try:
+            for record in self.iter_records(pid):
+                snapshot[record['PID']] = record
+                pulled += 1
+        finally:
+            self.date_params = date_params
+
+        # replaced once complete, so an interrupted write never 
+        # leaves a truncated snapshot next to the state file
+        write_dict_list_to_json(snapshot.values(), f'{snapshot_path}.tmp')
+        os.replace(f'{snapshot_path}.tmp', snapshot_path)
+
+        collection_full_path = os.path.join(export_path, f"{col_fname}.{filetype}")
+        print(collection_full_path)
+        write_records(snapshot.values(), collection_full_path,
+            filetype, self.fields, compresslevel)
+
+        # high-water mark is only moved once the snapshot and export are written
+        state[pid] = {
+            'high_water_mark': until.strftime(timestamp_format),
+            'records': len(snapshot)
+            }
+        write_json_file(state, state_path)
+
+        return pulled
+
+
+    def export_collections(self,
+        pids='all', filetype='csv', export_path='.',
+        col_fname=col_fname, max_collections=4, compresslevel=6):
+        """
+        Export several repository collections at the same time,
+        one file per collection ('<col_fname>_<pid>.<filetype>') plus
+        a membership table ('<col_fname>_membership.csv', tab delimited,
+        PID and collection of every record).
+
+        Collections share the instance connection pool, and requests
+        in flight across every collection are capped by max_workers.
+
+        When the API supports field selection and the collections 
+        overlap enough that their record counts add up to more than 
+        the whole IR, each collection is listed with its PIDs only and
+        the whole IR is pulled once, every record being written to 
+        each collection it belongs to. Otherwise collections are 
+        pulled concurrently, max_collections at a time.
+
+        Parameters:
+            pids: list of collection pids, or 'all' for every
+            collection of pid_dict (whole IR collection excluded).
+            filetype: see export_single_collection
+            export_path: '.', or current path is default arg.
+            col_fname: filename prefix. 'noaa_collection_YYYY_MM_DD' is default arg.
+            max_collections: number of collections pulled at the same time.
+            compresslevel: gzip level (1-9) of 'ndjson.gz' output.
+
+        Returns:
+            dict of collection pid: number of records exported.
+        """
+
+        if 'PID' not in self.fields:
+            raise Exception('PID field is required to export collections. Check your RepositoryQuery instance fields')
+
+        if filetype not in export_filetypes:
+            print('filetype not accepted')
+            return
+
+        if pids == 'all':
+            pids = [pid for pid in self.pid_dict.values() if pid != 'noaa']
+        pids = [str(pid) for pid in pids]
+
+        make_dir(export_path)
+        paths = {pid: os.path.join(export_path, f"{col_fname}_{pid}.{filetype}") 
+            for pid in pids}
+        flatten = filetype != 'parquet'
+        self.metrics.reset()
+
+        with ThreadPoolExecutor(max_workers=max_collections) as executor:
+            totals = dict(zip(pids + ['noaa'], executor.map(
+                lambda pid: get_row_total(self.api_url, pid, 
+                    self.date_params, self.transport),
+                pids + ['noaa'])))
+
+            if self.use_projection() and sum(totals[pid] for pid in pids) > totals['noaa']:
+                memberships = dict(zip(pids, 
+                    executor.map(self.list_collection_pids, pids)))
+                self.export_from_whole_collection(memberships, paths,
+                    filetype, flatten, compresslevel)
+            else:
+                memberships = dict(zip(pids, executor.map(
+                    lambda pid: self.export_member_collection(pid, 
+                        paths[pid], filetype, flatten, compresslevel),
+                    pids)))
+
+        for pid, path in paths.items():
+            print(path)
+
+        membership_path = os.path.join(export_path, f"{col_fname}_membership.csv")
+        print(membership_path)
+        collection_names = {pid: name for name, pid in self.pid_dict.items()}
+        write_dict_list_to_csv(
+            ({'PID': record_pid, 'collection_pid': pid, 
+                'collection': collection_names.get(pid, '')}
+                for pid in pids for record_pid in memberships[pid]),
+            membership_path, '\t', ['PID', 'collection_pid', 'collection'])
+
+        self.metrics.finish()
+        return {pid: len(memberships[pid]) for pid in pids}
+
+
+    def list_collection_pids(self, pid):
+        """
+        PIDs of every record of a collection, pulled with the
+        PID field only when the API supports field selection.
+
+        Returns:
+            list of PIDs (strings)
+        """
+
+        return [str(doc['PID']) for docs in 
+            self.iter_collection_pages(pid, fields=['PID']) for doc in docs]
+
+
+    def export_member_collection(self, pid, path, filetype, 
+        flatten, compresslevel):
+        """
+        Helper method for export_collections. Export a single
+        collection, keeping track of its record PIDs.
+
+        Returns:
+            list of PIDs (strings) exported
+        """
+
+        record_pids = []
+
+        def records():
+            for record in self.iter_records(pid, flatten):
+                record_pids.append(str(record['PID']))
+                yield record
+
+        write_records(self.metrics.metered(records()), path, filetype,
+            self.fields, compresslevel)
+        return record_pids
+
+
+    def export_from_whole_collection(self, memberships, paths, filetype,
+        flatten, compresslevel):
+        """
+        Helper method for export_collections. Pull the whole IR
+        once and write every record to the files of the collections
+        it belongs to.
+        """
+
+        record_collections = defaultdict(list)
+        for pid, record_pids in memberships.items():
+            for record_pid in record_pids:
+                record_collections[record_pid].append(pid)
+
+        writers = {pid: RecordQueueWriter(path, filetype, self.fields, compresslevel) 
+            for pid, path in paths.items()}
+        try:
+            for record in self.iter_records('noaa', flatten):
+                for pid in record_collections.get(str(record['PID']), ()):
+                    writers[pid].write(record)
+        finally:
+            RecordQueueWriter.close_all(writers.values())
+
+
+    def export_single_collection(self,
+        pid, filetype='csv',export_path='.',
+        col_fname=col_fname, compresslevel=6, aggregator=None):
+        
+        """
+        Export single repository collection data to CSV, JSON or
+        NDJSON (one compact JSON record per line).
+
+        Records are streamed with iter_records and written as
+        each page arrives.
+
+        Parameters:
+            pid: collection pid. can also be 'noaa' if entire colleciton.
+            filetype: 'csv' by default arg. 'json', 'ndjson', 
+            'ndjson.gz' (gzip compressed NDJSON) and 'parquet' (typed
+            columns, see write_parquet) as optional output.
+            export_path: '.', or current path is default arg.
+            col_fname: filename. 'noaa_collection_YYYY_MM_DD' is default arg.
+            compresslevel: gzip level (1-9) of 'ndjson.gz' output.
+            aggregator: optional FacetAggregator counting records
+            as they are exported.
+
+        Returns:
+            CSV, JSON, NDJSON or Parquet of a single IR collection.
+        """
+
+        if filetype not in export_filetypes:
+            print('filetype not accepted')
+            return
+
+        # creates directory if it doesn't exists
+        make_dir(export_path)
+
+        collection_full_path = os.path.join(export_path, f"{col_fname}.{filetype}")
+        print(collection_full_path)
+
+        #export data
+        # parquet keeps multivalued fields as lists
+        records = self.iter_records(pid, flatten=(filetype != 'parquet'))
+        if aggregator is not None:
+            records = aggregator.observe(records)
+        self.metrics.reset()
+        write_records(self.metrics.metered(records), collection_full_path, 
+            filetype, self.fields, compresslevel)
+        self.metrics.finish()
+
+    
+    def export_all_items(self,
+        filetype='csv',export_path='.',
+        col_fname=col_fname, compresslevel=6, aggregator=None):
+        """
+        Exports all repository items data to CSV, JSON, NDJSON
+        or Parquet.
+
+        Records are streamed with iter_records and written as
+        each page arrives.
+
+        Parameters:
+            filetype: 'csv' by default arg. 'json', 'ndjson', 
+            'ndjson.gz' (gzip compressed NDJSON) and 'parquet' (typed
+            columns, see write_parquet) as optional output.
+            export_path: '.', or current path is default arg.
+            col_fname: filename. 'noaa_collection_YYYY_MM_DD' is default arg.
+            compresslevel: gzip level (1-9) of 'ndjson.gz' output.
+            aggregator: optional FacetAggregator counting records
+            as they are exported.
+
+        Returns:
+            CSV, JSON, NDJSON or Parquet of all items.
+        """
+
+        self.export_single_collection('noaa', filetype,
+            export_path, col_fname, compresslevel, aggregator)
+
+
+    def export_exploded(self,
+        pid, fields, keep=('PID',), filetype='csv',
+        export_path='.', col_fname=col_fname, compresslevel=6):
+        """
+        Export a collection in long format (see iter_exploded) to
+        '<col_fname>_exploded.<filetype>'.
+
+        Parameters:
+            pid: collection pid. can also be 'noaa' if entire colleciton.
+            fields: multivalued fields exploded.
+            keep: fields copied to every row.
+            filetype: one of export_filetypes.
+            export_path: '.', or current path is default arg.
+            col_fname: filename. 'noaa_collection_YYYY_MM_DD' is default arg.
+            compresslevel: gzip level (1-9) of 'ndjson.gz' output.
+        """
+
+        if filetype not in export_filetypes:
+            print('filetype not accepted')
+            return
+
+        make_dir(export_path)
+        path = os.path.join(export_path, f"{col_fname}_exploded.{filetype}")
+        print(path)
+
+        self.metrics.reset()
+        write_records(self.metrics.metered(self.iter_exploded(pid, fields, keep)),
+            path, filetype, list(keep) + ['field', 'value'], compresslevel)
+        self.metrics.finish()
+
+
+class FieldProjector():
+    """
+    Filters IR documents on a list of fields. Compiled once from
+    the fields list and applied to whole pages (project_page).
+
+    Fields can be fnmatch patterns, e.g. 'DS*.checksum_txt_en' or
+    'mods.sm_*'. A pattern is replaced, in each document, by the
+    matching fields of the document in natural order (DS1, DS2, ..
+    DS10). Plain fields are always present in records, fields matched
+    by patterns only when the document has them.
+    Use compile_fields to reuse projectors.
+    """
+
+    delimiter = '~'
+
+    def __init__(self, fields):
+
+        self.fields = list(fields)
+        # compiled patterns by field
+        self.patterns = {field: re.compile(fnmatch.translate(field)) 
+            for field in self.fields if is_field_pattern(field)}
+        # document key: patterns matching it. keys repeat across
+        # documents, so each is matched once
+        self._matches = {}
+
+
+    def matching(self, key):
+        """
+        Returns:
+            tuple of patterns matching a document key
+        """
+
+        try:
+            return self._matches[key]
+        except KeyError:
+            matches = tuple(field for field, regex in self.patterns.items() 
+                if regex.match(key))
+            self._matches[key] = matches
+            return matches
+
+
+    def keys(self, doc):
+        """
+        Returns:
+            list of record fields of a document, in order.
+        """
+
+        if not self.patterns:
+            return self.fields
+
+        matched = defaultdict(list)
+        for key in doc:
+            for field in self.matching(key):
+                matched[field].append(key)
+
+        keys = []
+        for field in self.fields:
+            if field in self.patterns:
+                keys.extend(sorted(matched[field], key=natural_key))
+            else:
+                keys.append(field)
+        return keys
+
+
+    def project(self, doc):
+        """
+        Filter a document, same as field_iterator: missing fields are
+        '', multivalued fields are joined with '~' and newlines removed.
+
+        Returns:
+            record dict
+        """
+
+        get = doc.get
+        delimiter = self.delimiter
+        record = {}
+        for field in self.keys(doc):
+            value = get(field)
+            if value is None:
+                record[field] = ''
+                continue
+            if isinstance(value, list):
+                value = delimiter.join(value)
+            elif not isinstance(value, str):
+                value = str(value)
+            # most values have no newline, skips copying them
+            if '\n' in value or '\r' in value:
+                value = clean_text(value)
+            record[field] = value
+        return record
+
+
+    def select(self, doc):
+        """
+        Filter a document, keeping API values as is (lists for 
+        multivalued fields, None for missing fields).
+
+        Returns:
+            record dict
+        """
+
+        get = doc.get
+        return {field: get(field) for field in self.keys(doc)}
+
+
+    def subset(self, doc):
+        """
+        Fields of a document matching the projector, missing
+        fields left out. Used by the streaming parser.
+
+        Returns:
+            dict
+        """
+
+        return {field: doc[field] for field in self.keys(doc) if field in doc}
+
+
+    def project_page(self, docs, flatten=True):
+        """
+        Filter a page of documents.
+
+        Parameters:
+            docs: list (or iterable) of IR documents
+            flatten: if True, see project. if False, see select.
+
+        Returns:
+            list of record dicts
+        """
+
+        if flatten:
+            project = self.project
+        else:
+            project = self.select
+        return [project(doc) for doc in docs]
+
+
+    def columns(self, records):
+        """
+        Header of records filtered with wildcard fields: every field 
+        present in at least one record, patterns expanded in place.
+
+        Returns:
+            list of fields
+        """
+
+        if not self.patterns:
+            return self.fields
+
+        seen = set()
+        for record in records:
+            seen.update(record)
+        return self.keys(dict.fromkeys(sorted(seen, key=natural_key)))
+
+
+class FacetAggregator():
+    """
+    Facet counts, per-year histograms and sums of records, computed
+    in a single pass while records stream (see update and observe).
+
+    Records are filtered records (strings, see field_iterator).
+    Values of multivalued fields are split on '~' and each
+    value counted, like explode_fields.
+
+    Parameters:
+        facets: fields whose values are counted.
+        multivalued: fields split before counting.
+        year_field: field giving the year of a record, the first
+        4 characters are used (e.g. 'mods.ss_publishyear' or
+        'fgs.createdDate').
+        histograms: fields counted per year.
+        sums: list of (group field, value field) pairs. values of
+        value field are summed per value of group field.
+        names: display names of fields, used as table headers and
+        file names (e.g. {'mods.type_of_resource': 'Document Type'}).
+    """
+
+    delimiter = '~'
+
+    # kinds of sum tables named by quarterly_report/charts.py
+    sum_kinds = {'views': 'view_to_date'}
+
+    def __init__(self, facets=(), multivalued=(), year_field=None,
+        histograms=(), sums=(), names=None):
+
+        self.facets = list(facets)
+        self.multivalued = set(multivalued)
+        self.year_field = year_field
+        self.histograms = list(histograms)
+        self.sums = [tuple(pair) for pair in sums]
+        self.names = dict(names or {})
+
+        self.records = 0
+        self.counts = {field: Counter() for field in self.facets}
+        self.year_counts = {field: Counter() for field in self.histograms}
+        self.totals = {pair: defaultdict(int) for pair in self.sums}
+
+
+    def values(self, record, field):
+        """
+        Returns:
+            list of values of a record field, '' left out
+        """
+
+        value = record.get(field)
+        if value is None or value == '':
+            return []
+        if isinstance(value, list):
+            return [v for v in value if v not in (None, '')]
+        if field in self.multivalued:
+            return [v for v in str(value).split(self.delimiter) if v != '']
+        return [value]
+
+
+    def add(self, record):
+        """
+        Count a record.
+        """
+
+        self.records += 1
+        values = self.values
+
+        for field in self.facets:
+            self.counts[field].update(values(record, field))
+
+        if self.histograms and self.year_field is not None:
+            year = str(record.get(self.year_field) or '')[:4]
+            if year:
+                for field in self.histograms:
+                    self.year_counts[field].update(
+                        (year, value) for value in values(record, field))
+
+        for pair in self.sums:
+            group, value_field = pair
+            amount = to_number(record.get(value_field))
+            if amount:
+                totals = self.totals[pair]
+                for value in values(record, group):
+                    totals[value] += amount
+
+
+    def update(self, records):
+        """
+        Count every record of records.
+
+        Returns:
+            self
+        """
+
+        for record in records:
+            self.add(record)
+        return self
+
+
+    def observe(self, records):
+        """
+        Count records as they pass through, e.g. on their way
+        to an exporter.
+
+        Returns:
+            generator of the same records
+        """
+
+        for record in records:
+            self.add(record)
+            yield record
+
+
+    def name(self, field):
+        return self.names.get(field, field)
+
+
+    def tables(self):
+        """
+        Frequency tables of the counts, as lists of dicts. Tables
+        are named by (field name, kind), kind being:
+        - 'doc_counts': name, 'Count'. most frequent first
+        - 'by_year': 'Year', name, 'Count'. by year then count
+        - '<value name>_to_date': name, value name. smallest 
+        sum first, like quarterly_report/charts.py. sums of 'Views'
+        are 'view_to_date' tables, the name charts.py reads.
+
+        Names are lowercased with '_' for spaces (see table_name).
+
+        Returns:
+            dict of (name, kind): (fieldnames, rows)
+        """
+
+        tables = {}
+        for field, counts in self.counts.items():
+            name = self.name(field)
+            tables[(table_name(name), 'doc_counts')] = ([name, 'Count'],
+                [{name: value, 'Count': count} 
+                    for value, count in counts.most_common()])
+
+        for field, counts in self.year_counts.items():
+            name = self.name(field)
+            tables[(table_name(name), 'by_year')] = (['Year', name, 'Count'],
+                [{'Year': year, name: value, 'Count': counts[(year, value)]}
+                    for year, value in sorted(counts, 
+                        key=lambda key: (key[0], -counts[key], key[1]))])
+
+        for (group, value_field), totals in self.totals.items():
+            name, value_name = self.name(group), self.name(value_field)
+            kind = self.sum_kinds.get(table_name(value_name), 
+                f'{table_name(value_name)}_to_date')
+            tables[(table_name(name), kind)] = ([name, value_name], 
+                [{name: value, value_name: total} 
+                    for value, total in sorted(totals.items(), key=lambda item: item[1])])
+
+        return tables
+
+
+    def write_tables(self, export_path='.', qt_info=None):
+        """
+        Write frequency tables (see tables) as CSV files named
+        '<name>_<kind>.csv', or '<name>_<qt_info>_<kind>.csv' with
+        qt_info, as quarterly_report/charts.py names them.
+
+        Returns:
+            list of file paths
+        """
+
+        make_dir(export_path)
+        paths = []
+        for (name, kind), (fieldnames, rows) in self.tables().items():
+            parts = [name, kind] if qt_info is None else [name, qt_info, kind]
+            path = os.path.join(export_path, f"{'_'.join(parts)}.csv")
+            write_dict_list_to_csv(rows, path, ',', fieldnames)
+            paths.append(path)
+        return paths
+
+
+class FieldIndex():
+    """
+    In-memory inverted index over records (dicts) of collection data.
+
+    For each indexed field, values are lowercased once and kept with:
+    - token postings: word -> positions of records containing it
+    - n-gram postings: n characters -> positions of records containing them
+
+    Substring searches intersect the n-gram postings of the search value,
+    then check the few remaining candidates. Token and prefix searches 
+    use the token postings only. Records appended to the indexed list
+    are indexed on the next search.
+    """
+
+    def __init__(self, fields, ngram=3):
+
+        self.fields = list(fields)
+        self.ngram = ngram
+        self.set_records([])
+
+
+    def set_records(self, records):
+        """
+        Index a new list of records. Postings are cleared and
+        rebuilt on the next search.
+        """
+
+        self.records = records
+        self.values = {field: [] for field in self.fields}
+        self.tokens = {field: defaultdict(set) for field in self.fields}
+        self.grams = {field: defaultdict(set) for field in self.fields}
+        self.sorted_tokens = {}
+
+
+    def update(self):
+        """
+        Index records added to the records list since the last update.
+        """
+
+        for position in range(len(self.values[self.fields[0]]), len(self.records)):
+            record = self.records[position]
+            for field in self.fields:
+                value = index_value(record.get(field)).lower()
+                self.values[field].append(value)
+                for token in tokenize(value):
+                    self.tokens[field][token].add(position)
+                for gram in ngrams(value, self.ngram):
+                    self.grams[field][gram].add(position)
+                self.sorted_tokens.pop(field, None)
+
+
+    def match(self, field, search_value, mode='substring'):
+        """
+        Positions of records matching search_value on field.
+
+        Parameters:
+            field: indexed field
+            search_value: string searched
+            mode: 'substring' (same as RepositoryQuery.search_field), 
+            'token' (whole words, all of them) or 'prefix' (words 
+            starting with search_value).
+
+        Returns:
+            set of record positions
+        """
+
+        if field not in self.values:
+            raise Exception('field not present. Check your RepositoryQuery instance fields')
+
+        search_value = search_value.lower()
+
+        if mode == 'substring':
+            values = self.values[field]
+            if len(search_value) < self.ngram:
+                candidates = range(len(values))
+            else:
+                postings = sorted((self.grams[field].get(gram, set())
+                    for gram in ngrams(search_value, self.ngram)), key=len)
+                candidates = set.intersection(*postings)
+            return {pos for pos in candidates if search_value in values[pos]}
+
+        elif mode == 'token':
+            postings = [self.tokens[field].get(token, set()) 
+                for token in tokenize(search_value)]
+            return set.intersection(*postings) if postings else set()
+
+        elif mode == 'prefix':
+            if field not in self.sorted_tokens:
+                self.sorted_tokens[field] = sorted(self.tokens[field])
+            tokens = self.sorted_tokens[field]
+            matches = set()
+            i = bisect.bisect_left(tokens, search_value)
+            while i < len(tokens) and tokens[i].startswith(search_value):
+                matches |= self.tokens[field][tokens[i]]
+                i += 1
+            return matches
+
+        raise Exception(f"{mode} is not a valid mode. Use 'substring', 'token' or 'prefix'")
+
+
+    def search(self, criteria, match='all', mode='substring'):
+        """
+        Search on several fields.
+
+        Parameters:
+            criteria: dict of field: search_value
+            match: 'all' if every criteria must match, 'any' if
+            at least one must.
+            mode: see match method
+
+        Returns:
+            list of dicts, in collection data order.
+        """
+
+        self.update()
+
+        results = None
+        for field, search_value in criteria.items():
+            positions = self.match(field, search_value, mode)
+            if results is None:
+                results = positions
+            elif match == 'all':
+                results &= positions
+            else:
+                results |= positions
+
+        return [self.records[pos] for pos in sorted(results or ())]
+
+
+class DateWindowPlanner():
+    """
+    Splits a harvest into fgs.lastModifiedDate windows ('from' and
+    'until' params) of about target_rows records each.
+
+    Without a start date, the harvest starts at the oldest
+    fgs.lastModifiedDate (one sorted rows=1 probe, checked with a
+    count of older records), or at earliest if the API doesn't sort.
+    Windows are bisected on time until they hold at most target_rows
+    records, counting records with numFound probes (rows=0) sent in
+    parallel. Only the first half of a window is probed during the
+    bisection, the second half holds about the rest of its records.
+    Adjacent small windows are then merged, so windows are of roughly
+    equal size, and windows whose count was not probed are counted.
+
+    Params are whole seconds while modified dates can have fractions
+    of a second, so a window ends at the second the next one starts.
+    Records modified at that second are in both windows.
+    """
+
+    # start of harvests when the oldest record can't be found
+    earliest = '1970-01-01T00:00:00Z'
+
+    def __init__(self, api_url, pid, target_rows=20000, max_workers=1,
+        transport=None):
+
+        self.api_url = api_url
+        self.pid = pid
+        self.target_rows = target_rows
+        self.max_workers = max_workers
+        self.transport = transport
+        self.probes = 0
+        self._lock = threading.Lock()
+
+
+    def count(self, start, end):
+        """
+        Returns:
+            numFound of records modified between start and end
+        """
+
+        with self._lock:
+            self.probes += 1
+        return count_rows(self.api_url, self.pid, create_date_filter_params(
+            {'from': start, 'until': end}), self.transport)
+
+
+    def oldest(self):
+        """
+        Returns:
+            oldest fgs.lastModifiedDate of the collection (whole
+            seconds), None if the collection is empty, earliest
+            if the API ignored the sort param.
+        """
+
+        with self._lock:
+            self.probes += 1
+        url = (api_url_base_constructor(self.api_url, self.pid) 
+            + '?rows=1&sort=' + quote('fgs.lastModifiedDate asc'))
+        r = make_request(url, self.transport)
+        if isinstance(r, str):
+            raise Exception(f'{url}: {r}')
+        docs = r.json()['response']['docs']
+        if not docs:
+            return None
+
+        oldest = parse_timestamp(docs[0]['fgs.lastModifiedDate'])
+        # an unsorted response would leave older records out
+        if self.count(self.earliest, format_timestamp(oldest - 1)) > 0:
+            return self.earliest
+        return format_timestamp(oldest)
+
+
+    def plan(self, start, end):
+        """
+        Parameters:
+            start, end: 'YYYY-MM-DDTHH:MM:SSZ' timestamps (inclusive).
+            start is the oldest record if None.
+
+        Returns:
+            list of (from, until, numFound) windows in time order,
+            empty windows left out. each window ends at the second the
+            next one starts. numFound of windows may be higher than 
+            their records if records were modified while planning.
+        """
+
+        if start is None:
+            start = self.oldest()
+            if start is None:
+                return []
+
+        # (first, last, count, probed): probed is False for counts
+        # derived from the count of the parent window
+        accepted = []
+        todo = [(parse_timestamp(start), parse_timestamp(end), 
+            self.count(start, end), True)]
+
+        with ThreadPoolExecutor(max_workers=max(self.max_workers, 1)) as executor:
+            while todo:
+                split = []
+                for first, last, count, probed in todo:
+                    # records of a derived empty window are at its first
+                    # second, in the previous window too
+                    if count <= 0:
+                        continue
+                    # windows of a second can't be split further
+                    if count <= self.target_rows or last - first <= 1:
+                        accepted.append((first, last, count, probed))
+                    else:
+                        split.append((first, first + (last - first) // 2, last, count))
+
+                halves = list(executor.map(lambda window: self.count(
+                    format_timestamp(window[0]), format_timestamp(window[1])), split))
+                todo = []
+                for (first, middle, last, count), half in zip(split, halves):
+                    todo.append((first, middle, half, True))
+                    todo.append((middle, last, count - half, False))
+
+            # merge adjacent windows up to target_rows
+            windows = []
+            for first, last, count, probed in sorted(accepted):
+                if windows and windows[-1][2] + count <= self.target_rows:
+                    previous = windows.pop()
+                    windows.append((previous[0], last, previous[2] + count, 
+                        previous[3] and probed))
+                else:
+                    windows.append((first, last, count, probed))
+
+            # derived counts miss records at the second shared with the
+            # previous window, and would miss the last page of a window
+            counts = list(executor.map(lambda window: window[2] if window[3] 
+                else self.count(format_timestamp(window[0]), format_timestamp(window[1])),
+                windows))
+
+        return [(format_timestamp(first), format_timestamp(last), count)
+            for (first, last, _, _), count in zip(windows, counts) if count > 0]
+
+
+class PagePlanner():
+    """
+    Adaptive pagination plan covering rows 0 to row_total of a query.
+
+    Pages are handed out in order with next_range. After each page,
+    record adjusts the page size so a page takes about target_seconds
+    and at most max_page_bytes, within min_page_size and max_page_size.
+    A page that failed is split in two halves and handed out again 
+    before any new page, until pages reach min_page_size. Pages 
+    returned short are completed with the missing rows, so every row 
+    up to row_total is covered exactly once.
+    """
+
+    def __init__(self, row_total, page_size=5000, min_page_size=250,
+        max_page_size=20000, target_seconds=15, max_page_bytes=64 * 1024 ** 2):
+
+        self.row_total = row_total
+        self.page_size = page_size
+        self.min_page_size = min_page_size
+        self.max_page_size = max_page_size
+        self.target_seconds = target_seconds
+        self.max_page_bytes = max_page_bytes
+        self.next_start = 0
+        self.pending = deque()
+
+
+    def next_range(self):
+        """
+        Returns:
+            (start, rows) of next page to request, None if every
+            row has been handed out.
+        """
+
+        if self.pending:
+            return self.pending.popleft()
+
+        if self.next_start >= self.row_total:
+            return None
+
+        rows = min(self.page_size, self.row_total - self.next_start)
+        page = (self.next_start, rows)
+        self.next_start += rows
+        return page
+
+
+    def record(self, rows, seconds, received):
+        """
+        Adjust page size after a page of rows took seconds 
+        and received bytes.
+        """
+
+        if rows == 0:
+            return
+
+        size = self.target_seconds * rows / max(seconds, 0.001)
+        if self.max_page_bytes:
+            size = min(size, self.max_page_bytes * rows / max(received, 1))
+
+        # move half way to the measured size, at most doubling per page
+        size = min((self.page_size + size) / 2, self.page_size * 2)
+        self.page_size = int(max(self.min_page_size, min(self.max_page_size, size)))
+
+
+    def split(self, start, rows):
+        """
+        Split a failed page in two halves, requested before new pages.
+        Page size is halved as well.
+
+        Returns:
+            False if page is already at min_page_size and can't be split.
+        """
+
+        if rows <= self.min_page_size:
+            return False
+
+        half = rows // 2
+        self.pending.appendleft((start + half, rows - half))
+        self.pending.appendleft((start, half))
+        self.page_size = max(self.min_page_size, self.page_size // 2)
+        return True
+
+
+    def requeue(self, start, rows):
+        """
+        Hand out rows missing from a short page before new pages.
+        """
+        self.pending.appendleft((start, rows))
+
+
+class HarvestCheckpoint():
+    """
+    Pages of a harvest saved to a work directory, so a harvest
+    interrupted by an error resumes from its first missing page.
+
+    Each completed page is saved as 'page_<start>.json.gz'. The
+    manifest ('manifest.json') records the query, numFound, date
+    params and completed page offsets. A checkpoint is only resumed
+    for the same query and numFound: if records were added or removed
+    since the checkpoint was made, page offsets no longer match, and
+    the harvest starts over.
+    """
+
+    manifest_fname = 'manifest.json'
+
+    def __init__(self, work_dir):
+
+        self.work_dir = work_dir
+        self.manifest_path = os.path.join(work_dir, self.manifest_fname)
+        self.manifest = None
+        self._lock = threading.Lock()
+
+
+    def open(self, query, num_found):
+        """
+        Resume the checkpoint of a query, or start a new one.
+
+        Parameters:
+            query: dict describing the harvest (url, date params, page
+            size, fields). compared with the checkpoint query.
+            num_found: number of records the API reports now.
+
+        Returns:
+            sorted list of completed page offsets
+        """
+
+        os.makedirs(self.work_dir, exist_ok=True)
+        manifest = None
+        if os.path.exists(self.manifest_path):
+            manifest = read_json_file(self.manifest_path)
+
+        if manifest is not None and manifest['query'] != query:
+            print(f'{self.work_dir}: checkpoint of another query, starting over')
+            manifest = None
+        elif manifest is not None and manifest['numFound'] != num_found:
+            print(f"{self.work_dir}: numFound changed since checkpoint "
+                f"({manifest['numFound']} -> {num_found}), starting over")
+            manifest = None
+
+        if manifest is None:
+            self.clear()
+            os.makedirs(self.work_dir, exist_ok=True)
+            manifest = {
+                'query': query,
+                'numFound': num_found,
+                'created': datetime.now(timezone.utc).strftime(timestamp_format),
+                'completed': []
+                }
+            write_json_file(manifest, self.manifest_path)
+
+        self.manifest = manifest
+        return self.completed()
+
+
+    def completed(self):
+        with self._lock:
+            return sorted(self.manifest['completed'])
+
+
+    def page_path(self, offset):
+        return os.path.join(self.work_dir, f'page_{offset:010d}.json.gz')
+
+
+    def save_page(self, offset, docs):
+        """
+        Save a completed page and record its offset in the manifest.
+        Called from worker threads.
+        """
+
+        path = self.page_path(offset)
+        with gzip.open(f'{path}.tmp', 'wt', encoding='utf-8', compresslevel=1) as f:
+            json.dump(docs, f)
+        os.replace(f'{path}.tmp', path)
+
+        with self._lock:
+            if offset not in self.manifest['completed']:
+                self.manifest['completed'].append(offset)
+            self.manifest['updated'] = datetime.now(timezone.utc).strftime(timestamp_format)
+            write_json_file(self.manifest, self.manifest_path)
+
+
+    def load_page(self, offset):
+        """
+        Returns:
+            list of IR records of a saved page
+        """
+
+        with gzip.open(self.page_path(offset), 'rt', encoding='utf-8') as f:
+            return json.load(f)
+
+
+    def clear(self):
+        """
+        Remove saved pages and manifest.
+        """
+
+        for path in glob.glob(os.path.join(self.work_dir, 'page_*.json.gz*')):
+            os.remove(path)
+        if os.path.exists(self.manifest_path):
+            os.remove(self.manifest_path)
+        if os.path.isdir(self.work_dir) and not os.listdir(self.work_dir):
+            os.rmdir(self.work_dir)
+
+
+class RecordQueueWriter():
+    """
+    Writes records pushed with write to a file, with write_records 
+    running in its own thread. Used to write several files from a 
+    single stream of records. At most maxsize records are queued.
+    """
+
+    done = object()
+
+    def __init__(self, file_path, filetype, fieldnames, compresslevel=6,
+        maxsize=10000):
+
+        self.queue = queue.Queue(maxsize)
+        self.error = None
+        self.thread = threading.Thread(target=self.run,
+            args=(file_path, filetype, fieldnames, compresslevel), daemon=True)
+        self.thread.start()
+
+
+    def run(self, file_path, filetype, fieldnames, compresslevel):
+        try:
+            write_records(self.records(), file_path, filetype,
+                fieldnames, compresslevel)
+        except Exception as e:
+            self.error = e
+            # keep consuming so write never blocks
+            for _ in self.records():
+                pass
+
+
+    def records(self):
+        """
+        Returns:
+            generator of queued records until close is called
+        """
+        while True:
+            record = self.queue.get()
+            if record is self.done:
+                return
+            yield record
+
+
+    def write(self, record):
+        self.queue.put(record)
+
+
+    def close(self):
+        """
+        Wait for queued records to be written. Raises the
+        exception of the writer thread if it failed.
+        """
+
+        self.close_all([self])
+
+
+    @classmethod
+    def close_all(cls, writers):
+        """
+        Close every writer, even if some of them failed, then 
+        raise the exception of the first writer thread that failed.
+        """
+
+        writers = list(writers)
+        for writer in writers:
+            writer.queue.put(cls.done)
+        for writer in writers:
+            writer.thread.join()
+        for writer in writers:
+            if writer.error is not None:
+                raise writer.error
+
+
+class HarvestMetrics():
+    """
+    Measurements of a harvest or export:
+    - requests: count, bytes received, latency (total and max)
+    - stages: seconds, calls and memory high-water mark of each
+    stage ('count', 'download', 'decode', 'project', 'write')
+    - records produced and records per second
+
+    Every measurement is also sent as an event to registered hooks.
+
+    With profile_dir, each stage runs under cProfile and memory is
+    traced with tracemalloc; write_profile writes one report per stage.
+    Memory high-water marks are only measured while tracemalloc traces,
+    i.e. with profile_dir or if the caller started tracemalloc. The
+    high-water mark of a stage is the peak of traced memory (of the
+    whole process) while the stage ran, not the peak so far.
+    """
+
+    def __init__(self, profile_dir=None):
+
+        self.profile_dir = profile_dir
+        self.hooks = []
+        self._lock = threading.Lock()
+        self.reset()
+
+        if profile_dir is not None and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+
+    def reset(self):
+        """
+        Clear measurements. Called at the start of each export.
+        """
+
+        with self._lock:
+            self.started = time.perf_counter()
+            self.elapsed = None
+            self.records = 0
+            self.requests = {'count': 0, 'bytes': 0, 'seconds': 0.0, 'max_seconds': 0.0}
+            self.stages = {}
+            self.profiles = defaultdict(list)
+            # peaks of running stages, see fold_peak
+            self.active = {}
+
+
+    def add_hook(self, hook):
+        self.hooks.append(hook)
+
+
+    def emit(self, event):
+        for hook in self.hooks:
+            hook(event)
+
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Context manager timing a stage. Can be used from
+        several threads at once.
+        """
+
+        profiler = None
+        if self.profile_dir is not None:
+            profiler = cProfile.Profile()
+            try:
+                profiler.enable()
+            except ValueError:
+                # a profiler is already active in this thread
+                profiler = None
+
+        peak = [0]
+        with self._lock:
+            self.fold_peak()
+            self.active[id(peak)] = peak
+
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - started
+            if profiler is not None:
+                profiler.disable()
+                with self._lock:
+                    self.profiles[name].append(profiler)
+            with self._lock:
+                self.fold_peak()
+                self.active.pop(id(peak), None)
+            self.add_stage(name, seconds, peak[0])
+
+
+    def fold_peak(self):
+        """
+        Helper method, called with the lock held. Add the traced 
+        memory peak since the last call to the peaks of running 
+        stages, then reset it, so each stage gets the peak of its
+        own run, including nested and concurrent stages.
+        """
+
+        if not tracemalloc.is_tracing():
+            return
+        current = tracemalloc.get_traced_memory()[1]
+        for peak in self.active.values():
+            peak[0] = max(peak[0], current)
+        tracemalloc.reset_peak()
+
+
+    def add_stage(self, name, seconds, peak_memory=0):
+
+        with self._lock:
+            stage = self.stages.setdefault(name, 
+                {'seconds': 0.0, 'calls': 0, 'peak_memory': 0})
+            stage['seconds'] += seconds
+            stage['calls'] += 1
+            stage['peak_memory'] = max(stage['peak_memory'], peak_memory)
+
+        self.emit({'event': 'stage', 'stage': name, 'seconds': seconds,
+            'peak_memory': peak_memory})
+
+
+    def add_request(self, url, status, seconds, received=None):
+        """
+        Record a request. received is None for streamed 
+        responses, whose bytes are added once read (add_bytes).
+        """
+
+        with self._lock:
+            self.requests['count'] += 1
+            self.requests['bytes'] += received or 0
+            self.requests['seconds'] += seconds
+            self.requests['max_seconds'] = max(self.requests['max_seconds'], seconds)
+
+        self.emit({'event': 'request', 'url': url, 'status': status,
+            'seconds': seconds, 'bytes': received})
+
+
+    def add_bytes(self, received):
+        with self._lock:
+            self.requests['bytes'] += received
+
+
+    def add_records(self, count):
+        with self._lock:
+            self.records += count
+
+
+    def metered(self, records):
+        """
+        Wrap the records written by an exporter. Time spent
+        outside of the records generator is the 'write' stage.
+        With profile_dir, it is profiled the same way: the profiler
+        is paused while records are pulled, so stages producing 
+        them are profiled on their own.
+
+        Returns:
+            generator of records
+        """
+
+        profiler = None
+        if self.profile_dir is not None:
+            profiler = cProfile.Profile()
+        running = profiled = False
+
+        records = iter(records)
+        pulled = 0.0
+        started = time.perf_counter()
+        try:
+            while True:
+                if running:
+                    profiler.disable()
+                    running = False
+                pull_started = time.perf_counter()
+                try:
+                    record = next(records)
+                except StopIteration:
+                    break
+                finally:
+                    pulled += time.perf_counter() - pull_started
+                if profiler is not None:
+                    try:
+                        profiler.enable()
+                        running = profiled = True
+                    except ValueError:
+                        # a profiler is already active in this thread
+                        pass
+                yield record
+        finally:
+            if running:
+                profiler.disable()
+            # an empty profile can't be loaded by pstats
+            if profiled:
+                with self._lock:
+                    self.profiles['write'].append(profiler)
+
+        self.add_stage('write', time.perf_counter() - started - pulled)
+
+
+    def summary(self):
+        """
+        Returns:
+            dict of measurements since the last reset.
+        """
+
+        with self._lock:
+            elapsed = self.elapsed or time.perf_counter() - self.started
+            requests = dict(self.requests)
+            requests['avg_seconds'] = (requests['seconds'] / requests['count'] 
+                if requests['count'] else 0.0)
+            return {
+                'elapsed_seconds': elapsed,
+                'records': self.records,
+                'records_per_sec': self.records / elapsed if elapsed else 0.0,
+                'requests': requests,
+                'stages': {name: dict(stage) for name, stage in self.stages.items()}
+                }
+
+
+    def finish(self):
+        """
+        End of an export: sends the summary to hooks, and writes
+        profile reports when profiling.
+
+        Returns:
+            summary dict
+        """
+
+        self.elapsed = time.perf_counter() - self.started
+        summary = self.summary()
+        self.emit(dict(summary, event='summary'))
+        if self.profile_dir is not None:
+            self.write_profile()
+        return summary
+
+
+    def write_profile(self):
+        """
+        Write profile reports to profile_dir:
+        - '<stage>.prof': cProfile stats of the stage (all threads)
+        - '<stage>.txt': 30 most expensive functions by cumulative time
+        - 'memory.txt': memory high-water mark of each stage and the
+        25 largest allocation sites still traced
+        """
+
+        make_dir(self.profile_dir)
+
+        with self._lock:
+            profiles = {name: list(p) for name, p in self.profiles.items()}
+            stages = {name: dict(stage) for name, stage in self.stages.items()}
+
+        for name, profilers in profiles.items():
+            with open(os.path.join(self.profile_dir, f'{name}.txt'), 'w') as f:
+                stats = pstats.Stats(profilers[0], stream=f)
+                for profiler in profilers[1:]:
+                    stats.add(profiler)
+                stats.dump_stats(os.path.join(self.profile_dir, f'{name}.prof'))
+                stats.sort_stats('cumulative').print_stats(30)
+
+        with open(os.path.join(self.profile_dir, 'memory.txt'), 'w') as f:
+            f.write('stage\tseconds\tcalls\tpeak_memory_mb\n')
+            for name, stage in stages.items():
+                f.write(f"{name}\t{stage['seconds']:.3f}\t{stage['calls']}\t"
+                    f"{stage['peak_memory'] / 1024 ** 2:.1f}\n")
+            if tracemalloc.is_tracing():
+                f.write('\ntop allocation sites\n')
+                for stat in tracemalloc.take_snapshot().statistics('lineno')[:25]:
+                    f.write(f'{stat}\n')
+
+
+class RequestScheduler():
+    """
+    Adaptive limit on requests in flight (AIMD), shared by the
+    threads of a Transport.
+
+    The limit starts at 1 and doubles every limit successful requests
+    (slow start) until the first throttling, then grows by 1 every
+    limit successful requests while latency stays stable. On a
+    429/503 response, a connection error or latency rising above
+    latency_factor times its baseline, the limit is multiplied by
+    decrease, at most once per latency period. Latency is a short
+    average of recent requests and its baseline a long average, 
+    compared once warmup requests have completed. A Retry-After
+    header pauses every request until the time given, at most
+    max_pause seconds. max_rps is a hard ceiling on requests started
+    per second.
+    """
+
+    throttle_statuses = (429, 503)
+
+    def __init__(self, max_concurrency, min_concurrency=1, max_rps=None,
+        decrease=0.5, latency_factor=2.0, warmup=10, max_pause=60):
+
+        self.max_concurrency = max(max_concurrency or 1, 1)
+        self.min_concurrency = max(min(min_concurrency, self.max_concurrency), 1)
+        self.max_rps = max_rps
+        self.decrease = decrease
+        self.latency_factor = latency_factor
+        self.warmup = warmup
+        self.max_pause = max_pause
+
+        self.limit = float(self.min_concurrency)
+        # slow start until the first throttling
+        self.threshold = float(self.max_concurrency)
+        self.in_flight = 0
+        self.successes = 0
+        self.paused_until = 0.0
+        self.next_start = 0.0
+        self.latency = None
+        self.baseline = None
+        self.samples = 0
+        self.last_decrease = 0.0
+
+        self.stats = {'throttle_events': 0, 'latency_backoffs': 0,
+            'retry_after_pauses': 0, 'rate_limited': 0}
+        self._cond = threading.Condition()
+
+
+    def acquire(self):
+        """
+        Wait for a free slot, for the end of a Retry-After pause 
+        and for the requests per second ceiling.
+        """
+
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    self._cond.wait(self.paused_until - now)
+                elif self.in_flight >= int(self.limit):
+                    self._cond.wait()
+                else:
+                    break
+            self.in_flight += 1
+
+            delay = 0
+            if self.max_rps:
+                start = max(now, self.next_start)
+                self.next_start = start + 1 / self.max_rps
+                delay = start - now
+                if delay > 0:
+                    self.stats['rate_limited'] += 1
+
+        if delay > 0:
+            time.sleep(delay)
+
+
+    def release(self, status, seconds, retry_after=None):
+        """
+        Free a slot and adapt the limit to the outcome of the request.
+
+        Parameters:
+            status: response status code, None on a connection error,
+            a timeout or any other failed request.
+            seconds: request latency, including reading the body of
+            streamed responses
+            retry_after: seconds given by a Retry-After header, if any
+        """
+
+        with self._cond:
+            self.in_flight -= 1
+            now = time.monotonic()
+
+            if status is None or status in self.throttle_statuses:
+                if status is not None:
+                    self.stats['throttle_events'] += 1
+                if retry_after:
+                    self.paused_until = max(self.paused_until, 
+                        now + min(retry_after, self.max_pause))
+                    self.stats['retry_after_pauses'] += 1
+                self.backoff(now)
+
+            elif status < 400:
+                self.samples += 1
+                if self.latency is None:
+                    self.latency = self.baseline = seconds
+                else:
+                    self.latency += 0.3 * (seconds - self.latency)
+                    # baseline tracks latency closely during warmup
+                    weight = 0.3 if self.samples <= self.warmup else 0.05
+                    self.baseline += weight * (seconds - self.baseline)
+
+                if (self.samples > self.warmup 
+                    and self.latency > self.latency_factor * self.baseline):
+                    if self.backoff(now):
+                        self.stats['latency_backoffs'] += 1
+                else:
+                    self.successes += 1
+                    if self.successes >= int(self.limit):
+                        self.successes = 0
+                        if self.limit < self.threshold:
+                            self.limit = min(self.limit * 2, self.threshold)
+                        else:
+                            self.limit += 1
+                        self.limit = min(self.limit, self.max_concurrency)
+
+            self._cond.notify_all()
+
+
+    def backoff(self, now):
+        """
+        Helper method. Multiplicative decrease of the limit, at most 
+        once per latency period so a burst of failures of requests
+        sent together counts once.
+
+        Returns:
+            True if the limit was decreased
+        """
+
+        if now - self.last_decrease < (self.latency or 0):
+            return False
+        self.last_decrease = now
+        self.limit = max(self.limit * self.decrease, self.min_concurrency)
+        self.threshold = self.limit
+        self.successes = 0
+        return True
+
+
+    def get_stats(self):
+        """
+        Returns:
+            dict of current concurrency limit, requests in
+            flight and throttle counters
+        """
+
+        with self._cond:
+            stats = dict(self.stats)
+            stats['concurrency'] = int(self.limit)
+            stats['in_flight'] = self.in_flight
+        return stats
+
+
+class Transport():
+    """
+    Pooled HTTP session used for NOAA Repository API requests.
+
+    A single requests.Session is shared so connections are kept alive
+    and reused between pages. Responses are gzip compressed when the
+    server allows it. Requests failing with a connection error, a
+    timeout or a 429/5xx status code are retried with exponential
+    backoff and full jitter.
+
+    If a ResponseCache is passed, fresh cached responses are returned
+    without a request, and stale ones are revalidated with the
+    ETag/Last-Modified validators sent by the server.
+
+    With max_concurrency or max_rps, requests are scheduled by a
+    RequestScheduler, and retries wait at least the Retry-After
+    time sent by the server, up to backoff_max. Streamed responses
+    keep their slot until they are closed.
+    """
+
+    retry_statuses = (429, 500, 502, 503, 504)
+
+    def __init__(self, pool_connections=10, pool_maxsize=10,
+        retries=5, backoff_factor=0.5, backoff_max=60,
+        timeout=(10, 300), cache=None, max_concurrency=None,
+        metrics=None, max_rps=None):
+
+        self.cache = cache
+        self.metrics = metrics
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.backoff_max = backoff_max
+        self.timeout = timeout
+
+        self.session = requests.Session()
+        self.session.headers.update({'Accept-Encoding': 'gzip, deflate'})
+        self.adapter = HTTPAdapter(
+            pool_connections=pool_connections,
+            pool_maxsize=pool_maxsize)
+        self.session.mount('https://', self.adapter)
+        self.session.mount('http://', self.adapter)
+
+        self.stats = {'requests': 0, 'retries': 0, 'errors': 0}
+        self._lock = threading.Lock()
+        # transport whose stats are also counted, see child
+        self.parent = None
+        # adaptive cap on requests sent at the same time, across threads
+        if max_concurrency is None and max_rps is None:
+            self.scheduler = None
+        else:
+            self.scheduler = RequestScheduler(max_concurrency or pool_maxsize,
+                max_rps=max_rps, max_pause=backoff_max)
+
+
+    def get(self, url, **kwargs):
+        """
+        GET request with retries, served from cache when possible.
+
+        Parameters:
+            url: api url string.
+            kwargs: passed to send
+
+        Returns:
+            last response received. Raises the last connection
+            error or timeout if every attempt failed.
+        """
+
+        if self.cache is None:
+            return self.send(url, **kwargs)
+
+        entry = self.cache.get(url)
+        if entry is not None and self.cache.is_fresh(entry):
+            self.count('cache_hits')
+            return self.cache.to_response(url, entry)
+
+        if entry is not None:
+            headers = dict(kwargs.pop('headers', None) or {})
+            if entry['etag']:
+                headers['If-None-Match'] = entry['etag']
+            if entry['last_modified']:
+                headers['If-Modified-Since'] = entry['last_modified']
+            kwargs['headers'] = headers
+
+        r = self.send(url, **kwargs)
+
+        if r.status_code == 304 and entry is not None:
+            self.count('cache_revalidated')
+            self.cache.refresh(url)
+            # releases the scheduler slot of streamed responses
+            r.close()
+            return self.cache.to_response(url, entry)
+
+        self.count('cache_misses')
+        if r.status_code == 200 and kwargs.get('stream'):
+            self.cache.tee(url, r)
+        elif r.status_code == 200:
+            self.cache.put(url, r)
+        return r
+
+
+    def send(self, url, retries=None, **kwargs):
+        """
+        GET request with retries. Cache is not used.
+
+        Parameters:
+            url: api url string.
+            retries: number of retries. instance retries if None.
+            kwargs: passed to requests.Session.get
+
+        Returns:
+            last response received. Raises the last connection
+            error or timeout if every attempt failed. Streamed
+            responses must be closed, see hold_slot.
+        """
+
+        kwargs.setdefault('timeout', self.timeout)
+        if retries is None:
+            retries = self.retries
+
+        stream = kwargs.get('stream', False)
+
+        for attempt in range(retries + 1):
+            self.count('requests')
+            retry_after = None
+            if self.scheduler is not None:
+                self.scheduler.acquire()
+            started = time.perf_counter()
+            # status given to the scheduler, None if the request failed
+            status, held = None, False
+            try:
+                try:
+                    r = self.session.get(url, **kwargs)
+                except (requests.ConnectionError, requests.Timeout):
+                    self.record_request(url, None, started)
+                    if attempt == retries:
+                        self.count('errors')
+                        raise
+                else:
+                    status = r.status_code
+                    retry_after = parse_retry_after(r.headers.get('Retry-After'))
+                    # streamed bodies are counted once read, see read_docs
+                    received = None if stream else response_bytes(r)
+                    self.record_request(url, r.status_code, started, received)
+                    if (r.status_code not in self.retry_statuses 
+                        or attempt == retries):
+                        if r.status_code >= 400:
+                            self.count('errors')
+                        if stream and self.scheduler is not None:
+                            held = self.hold_slot(r, started, retry_after)
+                        return r
+                    r.close()
+            finally:
+                if self.scheduler is not None and not held:
+                    self.scheduler.release(status, 
+                        time.perf_counter() - started, retry_after)
+
+            self.count('retries')
+            time.sleep(max(self.backoff(attempt), 
+                min(retry_after or 0, self.backoff_max)))
+
+
+    def hold_slot(self, r, started, retry_after=None):
+        """
+        Helper method. Keep the scheduler slot of a streamed response
+        until the response is closed, so bodies being read count as
+        requests in flight and latency includes reading them.
+
+        Returns:
+            True
+        """
+
+        close = r.close
+        released = []
+
+        def close_and_release():
+            try:
+                close()
+            finally:
+                if not released:
+                    released.append(True)
+                    self.scheduler.release(r.status_code, 
+                        time.perf_counter() - started, retry_after)
+
+        r.close = close_and_release
+        return True
+
+
+    def record_request(self, url, status, started, received=None):
+        """
+        Count bytes received and send request measurements to metrics.
+        """
+
+        if received:
+            self.count('bytes', received)
+        if self.metrics is not None:
+            self.metrics.add_request(url, status, 
+                time.perf_counter() - started, received)
+
+
+    def add_received(self, received):
+        """
+        Count bytes of a streamed body, once read.
+        """
+
+        self.count('bytes', received)
+        if self.metrics is not None:
+            self.metrics.add_bytes(received)
+
+
+    def stage(self, name):
+        """
+        Returns:
+            context manager timing a stage in metrics, if any.
+        """
+
+        if self.metrics is None:
+            return nullcontext()
+        return self.metrics.stage(name)
+
+
+    def backoff(self, attempt):
+        """
+        Exponential backoff with full jitter.
+
+        Returns:
+            seconds to wait before retry number attempt + 1
+        """
+
+        delay = min(self.backoff_max, self.backoff_factor * 2 ** attempt)
+        return random.uniform(0, delay)
+
+
+    def child(self):
+        """
+        Transport sharing the session, cache, scheduler and metrics
+        of this one, with stats of its own that are also counted in
+        this transport's. Used to measure a single harvest while
+        others run.
+
+        Returns:
+            Transport
+        """
+
+        child = copy.copy(self)
+        child.parent = self
+        child.stats = {'requests': 0, 'retries': 0, 'errors': 0}
+        child._lock = threading.Lock()
+        return child
+
+
+    def count(self, stat, value=1):
+        """
+        Thread safe increment of a stats counter.
+        """
+
+        with self._lock:
+            self.stats[stat] = self.stats.get(stat, 0) + value
+        if self.parent is not None:
+            self.parent.count(stat, value)
+
+
+    def get_stats(self):
+        """
+        Returns:
+            copy of stats dict, including number of connections opened
+            and number of requests sent over an already open connection.
+        """
+
+        opened, sent = 0, 0
+        pools = self.adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is not None:
+                opened += pool.num_connections
+                sent += pool.num_requests
+
+        with self._lock:
+            stats = dict(self.stats)
+        stats['connections_opened'] = opened
+        stats['connections_reused'] = max(sent - opened, 0)
+        if self.scheduler is not None:
+            stats.update(self.scheduler.get_stats())
+        return stats
+
+
+class ResponseCache():
+    """
+    On-disk cache of API responses, keyed by full request URL.
+
+    Each entry is a gzip compressed body ('<key>.gz') and a small 
+    JSON metadata file ('<key>.json') holding the URL, time stored,
+    ETag/Last-Modified validators and headers. Entries older than 
+    ttl seconds are stale and revalidated by Transport. When the 
+    compressed bodies exceed max_bytes, least recently used entries
+    are removed. Bodies of streamed responses are copied to the
+    cache as they are read (see tee).
+    """
+
+    def __init__(self, cache_dir, ttl=3600, max_bytes=2 * 1024 ** 3,
+        compresslevel=6):
+
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.compresslevel = compresslevel
+        self._lock = threading.Lock()
+
+        make_dir(cache_dir)
+        self.size = sum(os.path.getsize(path) for path in self.body_paths())
+
+
+    def key(self, url):
+        """
+        Returns:
+            sha256 hex digest of url
+        """
+        return hashlib.sha256(url.encode('utf-8')).hexdigest()
+
+
+    def paths(self, url):
+        """
+        Returns:
+            (body path, metadata path) of url entry
+        """
+        key = self.key(url)
+        return (os.path.join(self.cache_dir, f'{key}.gz'),
+            os.path.join(self.cache_dir, f'{key}.json'))
+
+
+    def body_paths(self):
+        """
+        Returns:
+            list of body paths of every entry
+        """
+        return [os.path.join(self.cache_dir, f) 
+            for f in os.listdir(self.cache_dir) if f.endswith('.gz')]
+
+
+    def get(self, url):
+        """
+        Get cache entry of url. Access time of entry is updated.
+
+        Returns:
+            metadata dict with 'body' (bytes) added, None if url
+            is not cached.
+        """
+
+        body_path, meta_path = self.paths(url)
+        try:
+            meta = read_json_file(meta_path)
+            with gzip.open(body_path, 'rb') as f:
+                meta['body'] = f.read()
+        except (OSError, ValueError, EOFError):
+            return None
+
+        # mtime of body file is used as last access time for LRU eviction
+        try:
+            os.utime(body_path)
+        except OSError:
+            pass
+        return meta
+
+
+    def is_fresh(self, entry):
+        """
+        Returns:
+            True if entry was stored (or revalidated) less than ttl 
+            seconds ago.
+        """
+        return time.time() - entry['stored'] < self.ttl
+
+
+    def put(self, url, response):
+        """
+        Store response body and validators of url.
+        """
+
+        body_path, _ = self.paths(url)
+        tmp_path = f'{body_path}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(gzip.compress(response.content, self.compresslevel))
+        self.store(url, response, tmp_path)
+
+
+    def tee(self, url, response):
+        """
+        Store the body of a streamed response as it is read with
+        iter_content, so the body is never held in memory. The entry 
+        is stored once the whole body has been read, bodies read 
+        partly are left out.
+        """
+
+        iter_content = response.iter_content
+        body_path, _ = self.paths(url)
+
+        def tee_content(chunk_size=1, decode_unicode=False):
+            tmp_path = f'{body_path}.{threading.get_ident()}.tmp'
+            complete = False
+            try:
+                with gzip.open(tmp_path, 'wb', self.compresslevel) as f:
+                    for chunk in iter_content(chunk_size, decode_unicode):
+                        f.write(chunk.encode(response.encoding or 'utf-8') 
+                            if isinstance(chunk, str) else chunk)
+                        yield chunk
+                complete = True
+            finally:
+                if complete:
+                    self.store(url, response, tmp_path)
+                elif os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+
+        response.iter_content = tee_content
+
+
+    def store(self, url, response, tmp_path):
+        """
+        Helper method. Move a compressed body written to tmp_path
+        in place and store the validators of url.
+        """
+
+        body_path, meta_path = self.paths(url)
+        meta = {
+            'url': url,
+            'stored': time.time(),
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+            'encoding': response.encoding,
+            'headers': {'Content-Type': response.headers.get('Content-Type', '')}
+            }
+
+        with self._lock:
+            if os.path.exists(body_path):
+                self.size -= os.path.getsize(body_path)
+
+            size = os.path.getsize(tmp_path)
+            os.replace(tmp_path, body_path)
+            write_json_file(meta, meta_path)
+
+            self.size += size
+            self.evict()
+
+
+    def refresh(self, url):
+        """
+        Reset stored time of url entry after a 304 revalidation.
+        """
+
+        body_path, meta_path = self.paths(url)
+        with self._lock:
+            try:
+                meta = read_json_file(meta_path)
+            except (OSError, ValueError):
+                return
+            meta['stored'] = time.time()
+            write_json_file(meta, meta_path)
+
+
+    def evict(self):
+        """
+        Remove least recently used entries until size is under 
+        max_bytes. Called with lock held.
+        """
+
+        if self.size <= self.max_bytes:
+            return
+
+        entries = sorted(self.body_paths(), key=os.path.getmtime)
+        for body_path in entries:
+            if self.size <= self.max_bytes:
+                break
+            self.size -= os.path.getsize(body_path)
+            os.remove(body_path)
+            meta_path = f'{body_path[:-len(".gz")]}.json'
+            if os.path.exists(meta_path):
+                os.remove(meta_path)
+
+
+    def to_response(self, url, entry):
+        """
+        Build a requests.Response from a cache entry.
+        """
+
+        r = requests.Response()
+        r.status_code = 200
+        r.url = url
+        r._content = entry['body']
+        r._content_consumed = True
+        r.encoding = entry['encoding']
+        r.headers = CaseInsensitiveDict(entry['headers'])
+        r.from_cache = True
+        return r
+
+
+    ############################
+    ####### Functions ##########
+    ############################
+
+# filetypes accepted by export methods
+export_filetypes = ('csv', 'json', 'ndjson', 'ndjson.gz', 'parquet')
+
+# Parquet column types. fields not listed are strings, or lists of 
+# strings for multivalued ('sm_' solr prefix, or list values) fields
+parquet_int_fields = ('PID',)
+parquet_date_fields = ('fgs.createdDate', 'fgs.lastModifiedDate')
+# low-cardinality fields stored with dictionary encoding
+parquet_dictionary_fields = ('mods.type_of_resource',)
+
+# format of 'from' & 'until' timestamps used by the API
+timestamp_format = '%Y-%m-%dT%H:%M:%SZ'
+
+
+def field_iterator(json_data, fields):
+    """
+    Helper function. Filter one document on fields.
+    See FieldProjector.project
+
+    Return dict
+    """
+
+    return compile_fields(fields).project(json_data)
+
+
+def explode_fields(records, fields, keep=('PID',), delimiter='~'):
+    """
+    Long format of records: one row per value of each
+    multivalued field, in a single pass.
+
+    Values are lists (raw IR documents) or strings joined with
+    delimiter (filtered records, see field_iterator). Empty values
+    are left out.
+
+    Parameters:
+        records: list (or iterable) of dicts
+        fields: multivalued fields exploded
+        keep: fields copied to every row as they are
+        delimiter: delimiter of joined string values
+
+    Returns:
+        generator of dicts (keep fields, 'field', 'value')
+    """
+
+    for record in records:
+        kept = {field: record.get(field, '') for field in keep}
+        for field in fields:
+            values = record.get(field)
+            if not values:
+                continue
+            if isinstance(values, str):
+                values = values.split(delimiter)
+            for value in values:
+                if value is None or value == '':
+                    continue
+                if not isinstance(value, str):
+                    value = str(value)
+                if '\n' in value or '\r' in value:
+                    value = clean_text(value)
+                row = dict(kept)
+                row['field'] = field
+                row['value'] = value
+                yield row
+
+
+def to_number(value):
+    """
+    Helper function. Number of a record value, 0 
+    if empty or not a number.
+    """
+
+    if isinstance(value, (int, float)):
+        return value
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            return 0
+
+
+def table_name(name):
+    """
+    Helper function. File name of a field or display name,
+    e.g. 'Document Type' -> 'document_type'.
+    """
+    return re.sub(r'[^0-9a-z]+', '_', name.lower()).strip('_')
+
+
+# FieldProjector by tuple of fields, see compile_fields
+compiled_fields = {}
+
+# whether the API of an api url supports the 'fl' param, 
+# see RepositoryQuery.use_projection
+projection_support = {}
+projection_lock = threading.Lock()
+
+def compile_fields(fields):
+    """
+    Helper function. Compiled FieldProjector of a fields list,
+    shared by every caller using the same fields.
+
+    Returns:
+        FieldProjector
+    """
+
+    key = tuple(fields)
+    projector = compiled_fields.get(key)
+    if projector is None:
+        projector = compiled_fields[key] = FieldProjector(key)
+    return projector
+
+
+def is_field_pattern(field):
+    """
+    Helper function. True if field is a fnmatch pattern.
+    """
+    return any(char in field for char in '*?[')
+
+
+def natural_key(field):
+    """
+    Helper function. Sort key ordering numbers by value 
+    (DS2 before DS10).
+    """
+    return [int(part) if part.isdigit() else part 
+        for part in re.split(r'(\d+)', field)]
+
+
+def parse_retry_after(value):
+    """
+    Helper function. Seconds to wait given by a Retry-After
+    header, as seconds or an HTTP date.
+
+    Returns:
+        seconds, None if value is missing or not valid.
+    """
+
+    if not value:
+        return None
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=timezone.utc)
+    return max((retry_at - datetime.now(timezone.utc)).total_seconds(), 0)
+
+
+def response_bytes(r):
+    """
+    Number of bytes received for a response body, before
+    decompression when the server compressed it.
+    """
+
+    try:
+        received = r.raw.tell()
+    except (AttributeError, ValueError):
+        received = 0
+    if received:
+        return received
+    try:
+        return len(r.content)
+    except RuntimeError:
+        # body of a streamed response was already read
+        return 0
+
+
+def index_value(value):
+    """
+    Helper function for FieldIndex. Converts a field value to
+    a string, joining multivalued fields like field_iterator.
+    """
+
+    if value is None:
+        return ''
+    elif isinstance(value, list):
+        return '~'.join(str(v) for v in value)
+    return str(value)
+
+
+def tokenize(text):
+    """
+    Helper function for FieldIndex. Splits text into words.
+    """
+    return re.findall(r'\w+', text)
+
+
+def ngrams(text, n):
+    """
+    Helper function for FieldIndex. 
+    Returns set of every n characters long substring of text.
+    """
+    return {text[i:i + n] for i in range(len(text) - n + 1)}
+
+
+def make_request(url, transport=None, **kwargs):
+    """
+    Make request. Check for 200 status code. If not exit
+    script with sys.exit.  
+    
+    Parameters:
+        url: api url string.
+        transport: optional Transport. requests.get is used if None.
+        kwargs: passed to requests.get or Transport.get (e.g. stream)
+    
+    Returns:
+        Returns response, if not returns
+        message and quit program.
+    """
+
+    if transport is None:
+        r = requests.get(url, **kwargs)
+    else:
+        r = transport.get(url, **kwargs)
+    if r.status_code != 200:
+        r.close()
+        return 'status code did not return 200'
+    return r
+
+
+def get_row_total(api_url, pid, date_params, transport=None):
+    """
+    Get row total from collection. 
+
+    Parameters:
+        api_url: api url string
+        pid: collection pid. can also be 'noaa' if entire colleciton.
+        date_parameters: string formatted as 
+            'from=MMMM-YY-DDT00:00:00Z&until=MMMM-YY-DDT00:00:00Z'
+        transport: optional Transport. requests.get is used if None.
+
+    Returns row total for each collection, 
+    including entire NOAA IR collection. Raises an
+    exception naming the url if the request fails.
+    """
+
+    # conditional is based on whether the option
+    # was selected to use class method of 'add filter'
+    if date_params is None:
+        url = f'{api_url}{pid}'
+    else:
+        url = f'{api_url}{pid}?{date_params}'
+
+    r = make_request(url, transport)
+    if isinstance(r, str):
+        raise Exception(f'{url}: {r}')
+    data = r.json()
+    return data['response']['numFound']
+
+
+def count_rows(api_url, pid, date_params, transport=None):
+    """
+    numFound of a query, without any document (rows=0).
+    Raises an exception if the request fails.
+    """
+
+    url = api_url_base_constructor(api_url, pid) + '?rows=0'
+    if date_params is not None:
+        url += f'&{date_params}'
+    r = make_request(url, transport)
+    if isinstance(r, str):
+        raise Exception(f'{url}: {r}')
+    return r.json()['response']['numFound']
+
+
+def window_urls(api_url, pid, start, end, row_total, row_num=5000,
+    field_list=None):
+    """
+    Helper function. Page urls of a date window, see iterate_rows.
+
+    Returns:
+        list of api url strings, empty if row_total is 0.
+    """
+
+    if not row_total:
+        return []
+    date_params = create_date_filter_params({'from': start, 'until': end})
+    urls = iterate_rows(api_url, pid, row_total, date_params, row_num, field_list)
+    return [urls] if isinstance(urls, str) else urls
+
+
+def iterate_rows(api_url, col_pid, row_total, date_params, row_num=5000,
+    field_list=None): 
+    """
+    If total number of rows is less than 
+    chunk val a list of URLS is generated with 
+    a num appended with a query string
+
+    If field_list is passed, an 'fl' param asks the API
+    for those fields only.
+    """
+
+    url_base = api_url_base_constructor(api_url, col_pid)
+    extra_params = build_extra_params(date_params, field_list)
+
+    if row_total < row_num:
+        return f'{url_base}?rows={row_total}{extra_params}'
+    else:
+        chunk_array = split_equal(row_total, row_num)
+        # insert 0 at beginning of list
+        chunk_array.insert(0,0) 
+        cumsum_chunk_array = list(accumulate(chunk_array))
+
+        chunk_link_array = []
+
+        for chunk in cumsum_chunk_array:
+            if chunk != row_total:
+                chunk_url = f'{url_base}?rows={str(row_num)}&start={str(chunk)}{extra_params}'
+                chunk_link_array.append(chunk_url)
+                continue
+
+        return chunk_link_array
+
+    
+def build_extra_params(date_params, field_list=None):
+    """
+    Helper function for iterate_rows function.
+    Query string appended to page urls after rows/start params.
+
+    Parameters:
+        date_params: see create_date_filter_params. None if not filtered.
+        field_list: fields asked to the API ('fl' param). None for all.
+
+    Returns:
+        '' or query string starting with '&'
+    """
+
+    # conditional is based on whether the option
+    # was selected to use class method of 'add filter'
+    if date_params is None:
+        extra_params = ''
+    else:
+        extra_params = f'&{date_params}'
+
+    if field_list is not None:
+        extra_params += f"&fl={quote(','.join(field_list), safe=',*')}"
+
+    return extra_params
+
+
+def split_equal(total, row_num):
+    """
+    Helper function for iterate_rows function
+    """
+    li = [row_num] * math.floor((total / row_num))
+    return li
+
+
+def concat_json(api_url_info, max_workers=1, transport=None, checkpoint=None):
+    """
+    Function utilized to handle multiple or single api URL requests.
+
+    If multiple API URL requests are occur, pages are fetched with
+    iter_pages (concurrently when max_workers > 1) resulting in lists
+    of dicts. Lists are combined using itertools chain, in the same
+    order as the API URLs.
+
+    If single API request is made, only list of dicts is returned.
+
+    Parameters:
+        api_url_info: api url string or list of api url strings
+        max_workers: number of pages requested at the same time.
+        transport: optional Transport shared by every page request.
+        checkpoint: optional HarvestCheckpoint. pages already saved
+        are read from disk, see iter_checkpointed_pages.
+
+    Returns:
+        list of IR records. Response header is removed in the process. 
+        Neccessary for concating JSON.  
+    """
+
+    if checkpoint is not None:
+        pages = iter_checkpointed_pages(api_url_info, checkpoint,
+            max_workers=max_workers, transport=transport)
+    else:
+        pages = iter_pages(api_url_info, max_workers, transport)
+
+    #use itertools chain to concat lists together
+    return list(chain.from_iterable(pages))
+
+
+def iter_pages(api_url_info, max_workers=1, transport=None,
+    stream=False, fields=None):
+    """
+    Generator yielding the docs of each page, in api url order.
+
+    When max_workers > 1 pages are requested by a thread pool. At most
+    max_workers pages are in flight at once, so pages are yielded as
+    soon as they (and every page before them) have arrived.
+
+    Parameters:
+        api_url_info: api url string or list of api url strings
+        max_workers: number of pages requested at the same time.
+        transport: optional Transport shared by every page request.
+        stream: parse page bodies as they download (see iter_stream_docs)
+        fields: with stream, fields kept in each document. None for all.
+
+    Returns:
+        generator of lists of IR records (one list per page)
+    """
+
+    if isinstance(api_url_info, str):
+        api_url_info = [api_url_info]
+
+    if max_workers <= 1 or len(api_url_info) <= 1:
+        for url in api_url_info:
+            yield get_page_docs(url, transport, stream, fields)
+        return
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        urls = iter(api_url_info)
+        pending = deque()
+
+        for url in urls:
+            pending.append(executor.submit(get_page_docs, url, transport, stream, fields))
+            if len(pending) >= max_workers:
+                break
+
+        try:
+            while pending:
+                docs = pending.popleft().result()
+                # keep the pool full while the caller works on this page
+                for url in urls:
+                    pending.append(executor.submit(get_page_docs, url, transport, stream, fields))
+                    break
+                yield docs
+        finally:
+            for future in pending:
+                future.cancel()
+
+
+def iter_checkpointed_pages(api_url_info, checkpoint, row_num=5000,
+    max_workers=1, transport=None, stream=False, fields=None):
+    """
+    Generator yielding the docs of each page, in api url order, 
+    like iter_pages. Pages saved in checkpoint are read from disk;
+    missing pages are requested and saved as soon as they arrive,
+    so pages completed before an error are not requested again.
+    The checkpoint is cleared once every page has been yielded.
+
+    Parameters:
+        api_url_info: api url string or list of api url strings
+        (see iterate_rows). page i starts at row i * row_num.
+        checkpoint: opened HarvestCheckpoint
+        row_num: rows per page
+        max_workers: number of pages requested at the same time.
+        transport: optional Transport shared by every page request.
+        stream: parse page bodies as they download (see iter_stream_docs)
+        fields: with stream, fields kept in each document. None for all.
+
+    Returns:
+        generator of lists of IR records (one list per page)
+    """
+
+    if isinstance(api_url_info, str):
+        api_url_info = [api_url_info]
+
+    completed = set(checkpoint.completed())
+    offsets = [i * row_num for i in range(len(api_url_info))]
+    missing = iter([(offset, url) for offset, url in zip(offsets, api_url_info) 
+        if offset not in completed])
+
+    def fetch(offset, url):
+        docs = get_page_docs(url, transport, stream, fields)
+        checkpoint.save_page(offset, docs)
+        return docs
+
+    with ThreadPoolExecutor(max_workers=max(max_workers, 1)) as executor:
+        pending = {}
+
+        def submit_next():
+            for offset, url in missing:
+                pending[offset] = executor.submit(fetch, offset, url)
+                return
+
+        for _ in range(max(max_workers, 1)):
+            submit_next()
+
+        try:
+            for offset in offsets:
+                if offset in completed:
+                    yield checkpoint.load_page(offset)
+                    continue
+                docs = pending.pop(offset).result()
+                submit_next()
+                yield docs
+        finally:
+            for future in pending.values():
+                future.cancel()
+
+    checkpoint.clear()
+
+
+def iter_adaptive_pages(url_base, extra_params, planner,
+    max_workers=1, transport=None, retries=1, stream=False, fields=None):
+    """
+    Generator yielding the docs of each page planned by a PagePlanner,
+    in row order.
+
+    Up to max_workers pages are requested at the same time. As with
+    iter_pages, pages in flight and pages waiting for an earlier page
+    are at most max_workers, so a stalled page doesn't let finished
+    pages pile up in memory. Each page latency and size is fed back
+    to the planner. A page that fails
+    (after retries) is split into smaller pages; an exception is 
+    raised once a page at the planner min size fails.
+
+    Parameters:
+        url_base: api url of the collection (see api_url_base_constructor)
+        extra_params: date and field params (see build_extra_params)
+        planner: PagePlanner
+        max_workers: number of pages requested at the same time.
+        transport: Transport. a new one is created if None.
+        retries: retries of a page before it is split.
+        stream: parse page bodies as they download (see iter_stream_docs)
+        fields: with stream, fields kept in each document. None for all.
+
+    Returns:
+        generator of lists of IR records (one list per page)
+    """
+
+    if transport is None:
+        transport = Transport()
+
+    completed = {}
+    next_row = 0
+    window = max(max_workers, 1)
+
+    with ThreadPoolExecutor(max_workers=window) as executor:
+        in_flight = {}
+
+        while True:
+            # with nothing in flight, split or requeued pages come 
+            # first from the planner and fill the gap at next_row
+            while not in_flight or len(in_flight) + len(completed) < window:
+                page = planner.next_range()
+                if page is None:
+                    break
+                start, rows = page
+                url = f'{url_base}?rows={rows}&start={start}{extra_params}'
+                future = executor.submit(fetch_page_range, url, transport,
+                    retries, stream, fields)
+                in_flight[future] = page
+
+            if not in_flight:
+                break
+
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                start, rows = in_flight.pop(future)
+                try:
+                    docs, seconds, received = future.result()
+                except (Exception) as e:
+                    if planner.split(start, rows):
+                        continue
+                    for pending in in_flight:
+                        pending.cancel()
+                    raise Exception(f'page start={start} rows={rows} failed: {e}') from e
+
+                docs = docs[:rows]
+                if len(docs) == 0:
+                    raise Exception(f'page start={start} rows={rows} returned no records. '
+                        'Collection may have changed during the harvest')
+                if len(docs) < rows:
+                    planner.requeue(start + len(docs), rows - len(docs))
+                planner.record(len(docs), seconds, received)
+                completed[start] = docs
+
+            while next_row in completed:
+                docs = completed.pop(next_row)
+                next_row += len(docs)
+                yield docs
+
+
+def fetch_page_range(url, transport, retries=None, stream=False, fields=None):
+    """
+    Helper function for iter_adaptive_pages. 
+    Request a single page and measure it.
+
+    Returns:
+        (list of IR records, seconds, bytes received)
+    """
+
+    started = time.perf_counter()
+    with transport.stage('download'):
+        r = transport.get(url, retries=retries, stream=stream)
+    if r.status_code != 200:
+        r.close()
+        raise Exception(f'{url}: status code did not return 200')
+    docs = read_docs(r, transport, stream, fields)
+    return docs, time.perf_counter() - started, response_bytes(r)
+
+
+def get_page_docs(url, transport=None, stream=False, fields=None):
+    """
+    Request a single page and return its documents. With a
+    transport, the request and the reading of its body are retried
+    together on connection errors, timeouts, broken bodies and
+    retry statuses, up to transport.retries times.
+
+    Parameters:
+        url: api url string.
+        transport: optional Transport. requests.get is used if None.
+        stream: parse page body as it downloads (see iter_stream_docs)
+        fields: with stream, fields kept in each document. None for all.
+
+    Returns:
+        list of IR records. Raises an exception naming the
+        page url if the request did not return 200.
+    """
+
+    if transport is None:
+        with stage(transport, 'download'):
+            r = make_request(url, stream=stream)
+        if isinstance(r, str):
+            raise Exception(f'{url}: {r}')
+        return read_docs(r, transport, stream, fields)
+
+    # retried here rather than in Transport.send, so a
+    # body failing while it is read is requested again
+    retries = transport.retries
+    for attempt in range(retries + 1):
+        try:
+            with stage(transport, 'download'):
+                r = transport.get(url, retries=0, stream=stream)
+            if r.status_code in transport.retry_statuses:
+                r.close()
+                raise requests.HTTPError(
+                    f'{url}: status code {r.status_code}', response=r)
+            if r.status_code != 200:
+                r.close()
+                raise Exception(f'{url}: status code did not return 200')
+            return read_docs(r, transport, stream, fields)
+        except (requests.ConnectionError, requests.Timeout,
+            requests.exceptions.ChunkedEncodingError, requests.HTTPError) as e:
+            if attempt == retries:
+                raise
+            transport.count('retries')
+            retry_after = None
+            if getattr(e, 'response', None) is not None:
+                retry_after = parse_retry_after(e.response.headers.get('Retry-After'))
+            time.sleep(max(transport.backoff(attempt),
+                min(retry_after or 0, transport.backoff_max)))
+
+
+def read_docs(r, transport=None, stream=False, fields=None):
+    """
+    Documents of a page response. Timed as the 'decode' stage;
+    with stream, it includes reading the body.
+
+    Parameters:
+        r: response
+        transport: Transport counting the bytes of streamed responses
+        not served from its cache.
+        stream: parse body with iter_stream_docs instead of r.json()
+        fields: with stream, fields kept in each document. None for all.
+
+    Returns:
+        list of IR records.
+    """
+
+    with stage(transport, 'decode'):
+        if not stream:
+            return r.json()['response']['docs']
+
+        try:
+            docs = list(iter_stream_docs(r, fields))
+        finally:
+            r.close()
+
+    # cached bodies were not received from the API
+    if transport is not None and not getattr(r, 'from_cache', False):
+        transport.add_received(response_bytes(r))
+    return docs
+
+
+def stage(transport, name):
+    """
+    Helper function. Context manager timing a stage 
+    in the metrics of transport, if any.
+    """
+
+    if transport is None:
+        return nullcontext()
+    return transport.stage(name)
+
+
+def iter_stream_docs(r, fields=None, chunk_size=64 * 1024):
+    """
+    Incremental parser of a page response.
+
+    The body is read chunk_size bytes at a time. Documents of
+    the response.docs array are decoded and yielded one at a time
+    as soon as they are complete, so the whole body and its object
+    tree are never held in memory together.
+
+    Parameters:
+        r: response requested with stream=True
+        fields: fields (or patterns, see FieldProjector) kept in
+        each document. None keeps every field.
+
+    Returns:
+        generator of IR records.
+    """
+
+    if fields is not None:
+        fields = compile_fields(fields)
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder(r.encoding or 'utf-8')()
+    chunks = r.iter_content(chunk_size)
+
+    def read_more():
+        for chunk in chunks:
+            return text_decoder.decode(chunk)
+        return None
+
+    buffer = ''
+    seeker = DocsArraySeeker()
+    while True:
+        more = read_more()
+        if more is None:
+            raise Exception(f'{r.url}: response.docs not found in response')
+        buffer += more
+        pos = seeker.feed(buffer)
+        if pos is not None:
+            break
+        buffer = ''
+
+    while True:
+        # skip separators between documents
+        while True:
+            while pos < len(buffer) and buffer[pos] in ' \t\r\n,':
+                pos += 1
+            if pos < len(buffer):
+                break
+            more = read_more()
+            if more is None:
+                raise Exception(f'{r.url}: response ended inside response.docs')
+            buffer, pos = buffer[pos:] + more, 0
+
+        if buffer[pos] == ']':
+            # read the rest of the body, so the connection goes back 
+            # to the pool and a cached copy (see ResponseCache.tee) 
+            # is complete
+            for _ in chunks:
+                pass
+            return
+
+        try:
+            doc, end = decoder.raw_decode(buffer, pos)
+        except json.JSONDecodeError:
+            more = read_more()
+            if more is None:
+                raise
+            buffer, pos = buffer[pos:] + more, 0
+            continue
+
+        pos = end
+        if fields is None:
+            yield doc
+        else:
+            yield fields.subset(doc)
+
+
+class DocsArraySeeker():
+    """
+    Helper class for iter_stream_docs. Scans the start of a
+    response body, chunk by chunk, until the opening bracket
+    of the response.docs array.
+    """
+
+    def __init__(self):
+
+        self.path = []
+        self.key = None
+        self.last_string = None
+        self.in_string = False
+        self.escape = False
+        self.string = []
+
+
+    def feed(self, text):
+        """
+        Returns:
+            position in text following the '[' of response.docs,
+            None if it is not in text.
+        """
+
+        for pos, char in enumerate(text):
+            if self.in_string:
+                if self.escape:
+                    self.escape = False
+                    self.string.append(char)
+                elif char == '\\':
+                    self.escape = True
+                elif char == '"':
+                    self.in_string = False
+                    self.last_string = ''.join(self.string)
+                else:
+                    self.string.append(char)
+            elif char == '"':
+                self.in_string = True
+                self.string = []
+            elif char == ':':
+                self.key = self.last_string
+            elif char in '{[':
+                if char == '[' and self.path == [None, 'response'] and self.key == 'docs':
+                    return pos + 1
+                self.path.append(self.key)
+                self.key = None
+            elif char in '}]':
+                self.path.pop()
+                self.key = None
+            elif char == ',':
+                self.key = None
+
+        return None
+
+
+def check_pid(collection_info, pid):
+    """
+    Checks to see if pid is a valid pid repo collection pid.
+
+    Parameters:
+        pid: sting value
+
+    Returns:
+        Error message and exit program is value isn't valid; pid 
+        passed in if value is valid.
+    """
+    for collection_pid in collection_info.values():
+        if pid == collection_pid:
+            return pid
+    return f'{pid} is not a valid pid'
+
+
+def make_dir(filepath):
+    """
+    Creates directory in current working
+    directory if it doesn't exists
+
+    Paramaters:
+        filepath: filepath
+    
+    """
+    if os.path.exists(filepath) == False:
+        os.mkdir(filepath)
+
+
+def clean_text(text):
+    """
+    Clean text data.
+    """
+    text = text.replace('\n', '').replace('\r','')
+    return text
+
+
+def write_dict_list_to_csv(dict_li,file_path, delimiter, fieldnames):
+    """
+    Write Python dict list to CSV
+
+    Parameters:
+        dict_li: Python list (or iterable) of dictionaries
+        file_path: abs or relative file path. use to save CSV
+        delimiter: choose type of delimiter
+        fieldnames: function utilizes csv.DictWriter. Currently
+        written to require header.
+    """
+
+    with open(file_path, 'w',
+        newline='', encoding='utf-8') as fh:
+        
+        # list of dictionaries written to CSV
+        csvfile = csv.DictWriter(fh,
             delimiter=delimiter,
             fieldnames=fieldnames
             )
 
         csvfile.writeheader()
-        csvfile.writerows(dict_li) 
+        csvfile.writerows(dict_li)
+
+
+def write_dict_list_to_json(dict_li, file_path):
+    """
+    Write Python dict list to JSON.
+
+    Output is the same as json.dump(dict_li, f, indent=4), but
+    records are written one at a time so dict_li can be a generator.
+
+    Parameters:
+        dict_li: Python list (or iterable) of dictionaries
+        file_path: abs or relative file path. use to save JSON
+    """
+
+    with open(file_path, 'w') as fh:
+        first = True
+        for record in dict_li:
+            fh.write('[\n' if first else ',\n')
+            fh.write(indent_json(json.dumps(record, indent=4)))
+            first = False
+        fh.write('[]' if first else '\n]')
+
+
+def indent_json(text, prefix='    '):
+    """
+    Helper function for write_dict_list_to_json.
+    Indents every line of text by prefix.
+    """
+    return prefix + text.replace('\n', '\n' + prefix)
+
+
+def write_dict_list_to_ndjson(dict_li, file_path, compresslevel=None):
+    """
+    Write Python dict list to NDJSON: one compact JSON 
+    record per line, written as records are produced.
+
+    Parameters:
+        dict_li: Python list (or iterable) of dictionaries
+        file_path: abs or relative file path. use to save NDJSON
+        compresslevel: gzip level (1-9). file is not compressed if None.
+    """
+
+    if compresslevel is None:
+        fh = open(file_path, 'w', encoding='utf-8', newline='\n')
+    else:
+        fh = gzip.open(file_path, 'wt', compresslevel=compresslevel,
+            encoding='utf-8', newline='\n')
+
+    with fh:
+        for record in dict_li:
+            fh.write(json.dumps(record, ensure_ascii=False, separators=(',', ':')))
+            fh.write('\n')
+
+
+def read_ndjson(file_path):
+    """
+    Read NDJSON file one line at a time. Files ending 
+    in '.gz' are decompressed.
+
+    Parameters:
+        file_path: abs or relative file path.
+
+    Returns:
+        generator of dictionaries
+    """
+
+    if file_path.endswith('.gz'):
+        fh = gzip.open(file_path, 'rt', encoding='utf-8')
+    else:
+        fh = open(file_path, encoding='utf-8')
+
+    with fh:
+        for line in fh:
+            if line.strip():
+                yield json.loads(line)
+
+
+def write_parquet(records, file_path, fieldnames, row_group_size=5000,
+    compression='zstd'):
+    """
+    Write records to a Parquet file with typed columns. 
+    Requires pyarrow (pip install pyarrow).
+
+    Column types:
+    - parquet_int_fields: int64 ('noaa:' prefix removed from PIDs)
+    - parquet_date_fields: UTC timestamp
+    - parquet_dictionary_fields: dictionary encoded string
+    - multivalued fields: list of strings. multivalued fields are
+    those with an 'sm_' prefix or with list values in the first 
+    row group. '~' joined strings are split back into lists.
+    - other fields: string
+
+    Records are written one row group of row_group_size 
+    records at a time, as they are produced.
+
+    Parameters:
+        records: list (or iterable) of dictionaries
+        file_path: abs or relative file path. use to save Parquet
+        fieldnames: columns written
+        row_group_size: records per row group
+        compression: parquet compression codec
+    """
+
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise Exception('pyarrow is required for parquet export. Install it with: pip install pyarrow')
+
+    records = iter(records)
+    writer = None
+
+    try:
+        while True:
+            batch = [record for _, record in zip(range(row_group_size), records)]
+            if not batch:
+                break
+
+            if writer is None:
+                schema = parquet_schema(pa, batch, fieldnames)
+                writer = pq.ParquetWriter(file_path, schema, compression=compression)
+
+            columns = {}
+            for field in fieldnames:
+                column_type = schema.field(field).type
+                columns[field] = [parquet_value(record.get(field), field, column_type, pa)
+                    for record in batch]
+
+            writer.write_table(pa.table(columns, schema=schema))
+
+        if writer is None:
+            schema = parquet_schema(pa, [], fieldnames)
+            writer = pq.ParquetWriter(file_path, schema, compression=compression)
+    finally:
+        if writer is not None:
+            writer.close()
+
+
+def parquet_schema(pa, batch, fieldnames):
+    """
+    Helper function for write_parquet. 
+    Builds schema from field names and first row group.
+    """
+
+    schema_fields = []
+    for field in fieldnames:
+        if field in parquet_int_fields:
+            column_type = pa.int64()
+        elif field in parquet_date_fields:
+            column_type = pa.timestamp('s', tz='UTC')
+        elif (field.split('.')[-1].startswith('sm_') 
+            or any(isinstance(record.get(field), list) for record in batch)):
+            column_type = pa.list_(pa.string())
+        elif field in parquet_dictionary_fields:
+            column_type = pa.dictionary(pa.int32(), pa.string())
+        else:
+            column_type = pa.string()
+        schema_fields.append(pa.field(field, column_type))
+
+    return pa.schema(schema_fields)
+
+
+def parquet_value(value, field, column_type, pa):
+    """
+    Helper function for write_parquet. 
+    Converts a record value to its column type.
+    """
+
+    if value is None or value == '' or value == []:
+        return [] if pa.types.is_list(column_type) else None
+
+    if pa.types.is_list(column_type):
+        if isinstance(value, list):
+            return [clean_text(str(v)) for v in value]
+        return clean_text(str(value)).split('~')
+
+    if isinstance(value, list):
+        value = '~'.join(str(v) for v in value)
+
+    if pa.types.is_integer(column_type):
+        return int(str(value).rsplit(':', 1)[-1])
+
+    if pa.types.is_timestamp(column_type):
+        return datetime.fromisoformat(str(value).replace('Z', '+00:00'))
+
+    return clean_text(str(value))
+
+
+def write_records(records, file_path, filetype, fieldnames, compresslevel=6):
+    """
+    Write records to file_path in the format given by filetype.
+
+    Parameters:
+        records: list (or iterable) of dictionaries
+        file_path: abs or relative file path
+        filetype: one of export_filetypes
+        fieldnames: header of CSV output. with wildcard fields, CSV 
+        and Parquet records are first spooled to an NDJSON file next
+        to file_path to build the header, see spool_records.
+        compresslevel: gzip level (1-9) of 'ndjson.gz' output.
+    """
+
+    projector = compile_fields(fieldnames)
+    if projector.patterns and filetype in ('csv', 'parquet'):
+        spool_path = f'{file_path}.spool.ndjson'
+        try:
+            keys = spool_records(records, spool_path)
+            # columns of the keys found in every record
+            write_records(read_ndjson(spool_path), file_path, filetype,
+                projector.columns([keys]), compresslevel)
+        finally:
+            if os.path.exists(spool_path):
+                os.remove(spool_path)
+        return
+
+    # as CSV
+    if filetype == 'csv':
+        delimiter = '\t'
+        write_dict_list_to_csv(records, file_path,
+            delimiter, fieldnames)
+
+    # as JSON
+    elif filetype == 'json':
+        write_dict_list_to_json(records, file_path)
+
+    # as NDJSON
+    elif filetype == 'ndjson':
+        write_dict_list_to_ndjson(records, file_path)
+
+    elif filetype == 'ndjson.gz':
+        write_dict_list_to_ndjson(records, file_path, compresslevel)
+
+    # as Parquet
+    elif filetype == 'parquet':
+        write_parquet(records, file_path, fieldnames)
+
+    else:
+        raise Exception(f'{filetype} filetype not accepted')
+
+
+def spool_records(records, spool_path):
+    """
+    Helper function for write_records. Write records to an NDJSON
+    file, keeping only the set of their keys in memory, so the 
+    header of wildcard fields is known before the output is written.
+
+    Returns:
+        set of every key of records
+    """
+
+    keys = set()
+
+    def observed():
+        for record in records:
+            keys.update(record)
+            yield record
+
+    write_dict_list_to_ndjson(observed(), spool_path)
+    return keys
+
+
+def read_records(file_path, columns=None):
+    """
+    Read records of a file written by write_records. The
+    format is given by the file extension.
+
+    Parameters:
+        file_path: abs or relative file path
+        columns: Parquet columns read. None for all.
+
+    Returns:
+        generator of dictionaries
+    """
+
+    if file_path.endswith('.csv'):
+        with open(file_path, newline='', encoding='utf-8') as fh:
+            yield from csv.DictReader(fh, delimiter='\t')
+
+    elif file_path.endswith('.json'):
+        yield from read_json_file(file_path)
+
+    elif file_path.endswith(('.ndjson', '.ndjson.gz')):
+        yield from read_ndjson(file_path)
+
+    elif file_path.endswith('.parquet'):
+        try:
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise Exception('pyarrow is required to read parquet. Install it with: pip install pyarrow')
+        for batch in pq.ParquetFile(file_path).iter_batches(columns=columns):
+            yield from batch.to_pylist()
+
+    else:
+        raise Exception(f'{file_path}: filetype not accepted')
+
 
 def api_url_base_constructor(api_url, col_pid):
     """
@@ -506,9 +4053,81 @@ def create_date_filter_params(date_dict):
     Create 'from' & 'until' date filter params that
     can be added to initial NOAA IR API request in order to filter on request. 
     Filter is applied to fgs.modifieddate field.
+
+    Values are YYYY-MM-DD dates, or full 'YYYY-MM-DDTHH:MM:SSZ'
+    timestamps which are passed as is.
     """
 
-    return f"from={date_dict['from']}T00:00:00Z&until={date_dict['until']}T00:00:00Z"
+    from_date = format_filter_date(date_dict['from'])
+    until_date = format_filter_date(date_dict['until'])
+    return f"from={from_date}&until={until_date}"
+
+
+def format_filter_date(date):
+    """
+    Helper function for create_date_filter_params.
+    Appends midnight time to YYYY-MM-DD dates.
+    """
+
+    if 'T' in date:
+        return date
+    return f'{date}T00:00:00Z'
+
+
+def date_param_range(date_params):
+    """
+    Helper function. 'from' and 'until' timestamps of date params
+    built by create_date_filter_params.
+
+    Returns:
+        (from, until), None for missing values.
+    """
+
+    if not date_params:
+        return None, None
+    start = re.search(r'from=([^&]+)', date_params)
+    end = re.search(r'until=([^&]+)', date_params)
+    return (start.group(1) if start else None, end.group(1) if end else None)
+
+
+def parse_timestamp(timestamp):
+    """
+    Helper function. 'YYYY-MM-DD[THH:MM:SSZ]' to seconds since epoch.
+    """
+
+    # fractional seconds are left out
+    timestamp = re.sub(r'\.\d+', '', format_filter_date(timestamp))
+    return int(datetime.strptime(timestamp, timestamp_format)
+        .replace(tzinfo=timezone.utc).timestamp())
+
+
+def format_timestamp(seconds):
+    """
+    Helper function. Seconds since epoch to 'YYYY-MM-DDTHH:MM:SSZ'.
+    """
+    return datetime.fromtimestamp(seconds, timezone.utc).strftime(timestamp_format)
+
+
+def read_json_file(json_file):
+    """
+    helper function to read json file.
+    """
+
+    with open(json_file) as f:
+        return json.load(f)
+
+
+def write_json_file(data, json_file):
+    """
+    helper function to write json file. File is
+    written next to json_file first, then renamed,
+    so an interrupted write never leaves a partial file.
+    """
+
+    tmp_file = f'{json_file}.tmp'
+    with open(tmp_file, 'w') as f:
+        json.dump(data, f, indent=4)
+    os.replace(tmp_file, json_file)
 
 
 def read_toml_file(toml_file):
@@ -528,15 +4147,19 @@ def read_toml_file(toml_file):
 if __name__ == "__main__":
     # command line arg takes in toml file
     # toml file contains api fields you wish to pull from api
+    # optional '--profile <dir>' writes a profile report of each stage
     f_name = sys.argv[1]
     data = read_toml_file(f_name)
+    profile_dir = None
+    if '--profile' in sys.argv:
+        profile_dir = sys.argv[sys.argv.index('--profile') + 1]
     # instantiate class 
-    q = RepositoryQuery(data['fields'])
+    q = RepositoryQuery(data['fields'], profile_dir=profile_dir)
     
     # call method IF you want to create date params
     # date param information is stored in fields toml file.
     # do not use method if you want unfiltered report.
-    q.add_date_filtering()
+    q.add_date_filtering(data['date_params'])
 
     #use class methods to either export single collection all items from IR
     #CSV is the default file format, but you can specify json for that format
@@ -545,4 +4168,7 @@ if __name__ == "__main__":
     # to export entire collection...
     # no args are required, but optional include args include filepath, filename,
     # and filetype (CSV, JSON) 
-    #q.export_all_items('json')
\ No newline at end of file
+    #q.export_all_items('json')
+
+    # to refresh an export with only the records modified since the last run...
+    #q.sync_collection('noaa', 'csv')
@@ -0,0 +1,488 @@
+import os, re, sys, mmap, time, hashlib, argparse, threading
+from datetime import datetime, timezone
+from urllib.parse import urlparse
+from concurrent.futures import (ThreadPoolExecutor, ProcessPoolExecutor, 
+    wait, FIRST_COMPLETED)
+import requests
+from api_query import (RepositoryQuery, Transport, response_bytes, make_dir,
+    read_json_file, write_json_file, read_records, timestamp_format,
+    parse_retry_after)
+
+"""
+Class used to download the DS attachment files of IR records:
+- AttachmentDownloader
+
+Class used to check downloaded files against their DS checksums:
+- AttachmentAuditor
+
+Usage:
+    python attachments.py download 5 attachments --workers 8 --per-host 4
+    python attachments.py audit noaa_collection.csv attachments --workers 8
+"""
+
+
+# fields needed to download the attachments of a record
+attachment_fields = ['PID', 'DS*.label_txt_en', 'DS*.filesize_tl',
+    'DS*.checksum_txt_en', 'DS*.sourceurl']
+
+ds_label = re.compile(r'DS(\d+)\.label_txt_en$')
+
+
+class AttachmentDownloader():
+    """
+    Downloads the DS1..DSn files of IR records.
+
+    Files are streamed to '<download_dir>/<PID>/<file name>' in
+    chunks, several at a time with at most per_host downloads per
+    host. A download is written to a '.part' file first and hashed
+    (sha256) as it arrives. An interrupted download is resumed with
+    an HTTP Range request. The file is only renamed once its checksum
+    matches DSn.checksum_txt_en. Files already present with a matching
+    checksum are skipped.
+
+    Results are saved to a manifest in download_dir, merged with the
+    results of previous runs.
+    """
+
+    manifest_fname = 'attachments_manifest.json'
+
+    def __init__(self, download_dir, max_workers=8, per_host=4,
+        item_url=RepositoryQuery.item_url, transport=None,
+        chunk_size=1024 ** 2):
+
+        self.download_dir = download_dir
+        self.max_workers = max_workers
+        self.per_host = per_host
+        self.item_url = item_url
+        self.chunk_size = chunk_size
+        # no max_concurrency, downloads are capped per host instead
+        self.transport = transport or Transport(pool_maxsize=max(10, max_workers))
+        self.manifest_path = os.path.join(download_dir, self.manifest_fname)
+
+        self.hosts = {}
+        self._lock = threading.Lock()
+
+
+    def attachments(self, doc):
+        """
+        DS files of a record.
+
+        Parameters:
+            doc: IR document, or record exported with attachment_fields
+
+        Returns:
+            list of dicts (pid, ds, url, path, size, checksum)
+        """
+
+        return record_attachments(doc, self.download_dir, self.item_url)
+
+
+    def download(self, docs):
+        """
+        Download the attachments of records.
+
+        Parameters:
+            docs: list (or iterable) of IR documents. Can be a
+            generator, e.g. RepositoryQuery.iter_records(pid,
+            flatten=False) with attachment_fields.
+
+        Returns:
+            dict of '<PID>/<DS>': result dict (url, path, bytes, sha256,
+            status, error). status is 'downloaded', 'resumed',
+            'skipped' or 'failed'.
+        """
+
+        make_dir(self.download_dir)
+        manifest = {}
+        if os.path.exists(self.manifest_path):
+            manifest = read_json_file(self.manifest_path)
+
+        results = {}
+        pending = {}
+        try:
+            with ThreadPoolExecutor(self.max_workers) as executor:
+                for doc in docs:
+                    for attachment in self.attachments(doc):
+                        # bounded number of queued downloads
+                        if len(pending) >= self.max_workers * 4:
+                            self.collect(pending, results)
+                        future = executor.submit(self.fetch, attachment)
+                        pending[future] = attachment
+                while pending:
+                    self.collect(pending, results)
+        finally:
+            manifest.update(results)
+            write_json_file(manifest, self.manifest_path)
+
+        return results
+
+
+    def collect(self, pending, results):
+        """
+        Helper method. Waits for at least one download and
+        moves finished downloads from pending to results.
+        """
+
+        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            attachment = pending.pop(future)
+            try:
+                result = future.result()
+            except Exception as e:
+                result = self.result(attachment, 'failed', error=str(e))
+            results[f"{attachment['pid']}/{attachment['ds']}"] = result
+
+
+    def host_slots(self, url):
+        """
+        Returns:
+            semaphore capping downloads from the host of url
+        """
+
+        host = urlparse(url).netloc
+        with self._lock:
+            if host not in self.hosts:
+                self.hosts[host] = threading.BoundedSemaphore(self.per_host)
+            return self.hosts[host]
+
+
+    def fetch(self, attachment):
+        """
+        Download one attachment, resuming its '.part' file if any.
+
+        Returns:
+            result dict
+        """
+
+        path, url = attachment['path'], attachment['url']
+        size, checksum = attachment['size'], attachment['checksum']
+
+        if os.path.exists(path) and self.is_complete(path, size, checksum):
+            return self.result(attachment, 'skipped', os.path.getsize(path))
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        part = f'{path}.part'
+        hasher = hashlib.sha256()
+        received = 0
+        if os.path.exists(part):
+            received = file_sha256(part, hasher, self.chunk_size)
+        status = 'resumed' if received else 'downloaded'
+
+        # retried here rather than in Transport.send, so
+        # each attempt resumes from the bytes written so far
+        retries = self.transport.retries
+        for attempt in range(retries + 1):
+            # identity encoding, so Range offsets are file offsets
+            headers = {'Accept-Encoding': 'identity'}
+            if received:
+                headers['Range'] = f'bytes={received}-'
+            try:
+                with self.host_slots(url):
+                    r = self.transport.send(url, retries=0, stream=True, 
+                        headers=headers)
+                    try:
+                        # part file already holds the whole file
+                        if r.status_code == 416 and received:
+                            break
+                        if r.status_code in self.transport.retry_statuses:
+                            raise requests.HTTPError(
+                                f'{url}: status code {r.status_code}', response=r)
+                        if r.status_code not in (200, 206):
+                            raise Exception(f'{url}: status code {r.status_code}')
+                        # server ignored the Range header
+                        if r.status_code == 200 and received:
+                            hasher = hashlib.sha256()
+                            received = 0
+                        with open(part, 'ab' if received else 'wb') as f:
+                            for chunk in r.iter_content(self.chunk_size):
+                                f.write(chunk)
+                                hasher.update(chunk)
+                                received += len(chunk)
+                    finally:
+                        r.close()
+                        self.transport.add_received(response_bytes(r))
+                break
+            except (requests.ConnectionError, requests.Timeout,
+                requests.exceptions.ChunkedEncodingError, requests.HTTPError) as e:
+                # next attempt resumes from the bytes written so far
+                if attempt == retries:
+                    return self.result(attachment, 'failed', received, error=str(e))
+                retry_after = None
+                if getattr(e, 'response', None) is not None:
+                    retry_after = parse_retry_after(e.response.headers.get('Retry-After'))
+                time.sleep(max(self.transport.backoff(attempt),
+                    min(retry_after or 0, self.transport.backoff_max)))
+
+        digest = hasher.hexdigest()
+        if checksum is not None and digest != checksum:
+            os.remove(part)
+            # part file may have been corrupt, download once from scratch
+            if status == 'resumed':
+                return self.fetch(attachment)
+            return self.result(attachment, 'failed', received, digest,
+                'checksum mismatch')
+        if checksum is None and size is not None and received != size:
+            os.remove(part)
+            return self.result(attachment, 'failed', received, digest,
+                'size mismatch')
+
+        os.replace(part, path)
+        return self.result(attachment, status, received, digest)
+
+
+    def is_complete(self, path, size, checksum):
+        """
+        True if a downloaded file matches the size and checksum
+        of its record. Sizes are compared first.
+        """
+
+        if size is not None and os.path.getsize(path) != size:
+            return False
+        if checksum is None:
+            return True
+        return file_sha256(path, chunk_size=self.chunk_size) == checksum
+
+
+    def result(self, attachment, status, received=0, digest=None, error=None):
+        """
+        Helper method. Manifest entry of an attachment.
+        """
+
+        if digest is None and status == 'skipped':
+            digest = attachment['checksum']
+        return {
+            'pid': attachment['pid'],
+            'ds': attachment['ds'],
+            'url': attachment['url'],
+            'path': attachment['path'],
+            'bytes': received,
+            'sha256': digest,
+            'status': status,
+            'error': error,
+            'updated': datetime.now(timezone.utc).strftime(timestamp_format)
+            }
+
+
+class AttachmentAuditor():
+    """
+    Checks downloaded DS files against the filesize_tl and
+    checksum_txt_en values of their records.
+
+    Sizes are compared first. Files of the expected size are hashed
+    (sha256 of a memory-mapped read) across a process pool. Digests
+    are cached by (path, size, mtime) in download_dir, so only new
+    or modified files are hashed again by later audits.
+    """
+
+    cache_fname = 'audit_cache.json'
+
+    def __init__(self, download_dir, max_workers=None,
+        item_url=RepositoryQuery.item_url):
+
+        self.download_dir = download_dir
+        self.max_workers = max_workers or os.cpu_count()
+        self.item_url = item_url
+        self.cache_path = os.path.join(download_dir, self.cache_fname)
+
+
+    def read_cache(self):
+        """
+        Returns:
+            dict of path: [size, mtime_ns, sha256]
+        """
+
+        if not os.path.exists(self.cache_path):
+            return {}
+        return read_json_file(self.cache_path)
+
+
+    def audit(self, records):
+        """
+        Audit the attachments of records.
+
+        Parameters:
+            records: list (or iterable) of IR documents, or records of
+            a snapshot export with the DS fields (see read_records).
+
+        Returns:
+            dict of '<PID>/<DS>': result dict (path, size, sha256,
+            status, hashed). status is 'ok', 'missing', 'size mismatch'
+            or 'checksum mismatch'. hashed is False when the
+            digest came from the cache.
+        """
+
+        cache = self.read_cache()
+        results = {}
+        # path: results waiting for the digest of the file
+        to_hash = {}
+
+        for doc in records:
+            for attachment in record_attachments(doc, self.download_dir,
+                self.item_url):
+                path = attachment['path']
+                result = {'pid': attachment['pid'], 'ds': attachment['ds'],
+                    'path': path, 'size': None, 'sha256': None,
+                    'checksum': attachment['checksum'], 'status': 'ok', 
+                    'hashed': False}
+                results[f"{attachment['pid']}/{attachment['ds']}"] = result
+
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    result['status'] = 'missing'
+                    continue
+                result['size'] = stat.st_size
+
+                if attachment['size'] is not None and stat.st_size != attachment['size']:
+                    result['status'] = 'size mismatch'
+                    continue
+                if attachment['checksum'] is None:
+                    continue
+
+                cached = cache.get(path)
+                if cached is not None and cached[:2] == [stat.st_size, stat.st_mtime_ns]:
+                    result['sha256'] = cached[2]
+                else:
+                    to_hash.setdefault(path, (stat, []))[1].append(result)
+
+        if to_hash:
+            paths = list(to_hash)
+            with ProcessPoolExecutor(self.max_workers) as executor:
+                digests = executor.map(mmap_sha256, paths,
+                    chunksize=max(1, len(paths) // (self.max_workers * 16)))
+                for path, digest in zip(paths, digests):
+                    stat, waiting = to_hash[path]
+                    cache[path] = [stat.st_size, stat.st_mtime_ns, digest]
+                    for result in waiting:
+                        result['sha256'] = digest
+                        result['hashed'] = True
+
+        for result in results.values():
+            if result['sha256'] is not None and result['sha256'] != result['checksum']:
+                result['status'] = 'checksum mismatch'
+
+        if to_hash:
+            make_dir(self.download_dir)
+            write_json_file(cache, self.cache_path)
+        return results
+
+
+def record_attachments(doc, download_dir, item_url=RepositoryQuery.item_url):
+    """
+    DS files of a record, see AttachmentDownloader.attachments.
+
+    Returns:
+        list of dicts (pid, ds, url, path, size, checksum)
+    """
+
+    pid = str(doc['PID'])
+    found = []
+    for key in doc:
+        match = ds_label.match(key)
+        if match is None or not doc[key]:
+            continue
+
+        ds = f'DS{match.group(1)}'
+        url = doc.get(f'{ds}.sourceurl')
+        if not url:
+            extension = os.path.splitext(doc[key])[1]
+            url = f'{item_url}{pid}/noaa_{pid}_{ds}{extension}'
+        size = doc.get(f'{ds}.filesize_tl')
+        checksum = doc.get(f'{ds}.checksum_txt_en')
+
+        found.append({
+            'pid': pid,
+            'ds': ds,
+            'url': url,
+            'path': os.path.join(download_dir, pid,
+                os.path.basename(urlparse(url).path)),
+            'size': int(size) if size not in (None, '') else None,
+            'checksum': checksum.lower() if checksum else None
+            })
+    return found
+
+
+def mmap_sha256(file_path):
+    """
+    sha256 of a file read through a memory map. Runs in
+    AttachmentAuditor worker processes.
+
+    Returns:
+        hex digest
+    """
+
+    with open(file_path, 'rb') as f:
+        # empty files can't be mapped
+        if os.fstat(f.fileno()).st_size == 0:
+            return hashlib.sha256().hexdigest()
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            return hashlib.sha256(m).hexdigest()
+
+
+def file_sha256(file_path, hasher=None, chunk_size=1024 ** 2):
+    """
+    Hash a file, reading chunk_size bytes at a time.
+
+    Parameters:
+        hasher: hashlib object updated with the file content.
+        a new sha256 if None.
+
+    Returns:
+        hex digest if hasher is None, else number of bytes read
+    """
+
+    new = hasher is None
+    if new:
+        hasher = hashlib.sha256()
+
+    read = 0
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            hasher.update(chunk)
+            read += len(chunk)
+
+    return hasher.hexdigest() if new else read
+
+
+def count_statuses(results):
+    """
+    Helper function.
+
+    Returns:
+        dict of status: number of results
+    """
+
+    statuses = {}
+    for result in results.values():
+        statuses[result['status']] = statuses.get(result['status'], 0) + 1
+    return statuses
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='DS attachments of IR records')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    download = commands.add_parser('download', help='download attachments of a collection')
+    download.add_argument('pid', help="collection pid, 'noaa' for the entire IR")
+    download.add_argument('download_dir')
+    download.add_argument('--workers', type=int, default=8)
+    download.add_argument('--per-host', type=int, default=4)
+
+    audit = commands.add_parser('audit', help='check downloaded attachments')
+    audit.add_argument('snapshot', help='export with DS fields (csv, json, ndjson, parquet)')
+    audit.add_argument('download_dir')
+    audit.add_argument('--workers', type=int, default=None,
+        help='hashing processes. number of CPUs by default')
+    args = parser.parse_args()
+
+    if args.command == 'download':
+        q = RepositoryQuery(attachment_fields, max_workers=4)
+        downloader = AttachmentDownloader(args.download_dir, args.workers, args.per_host)
+        statuses = count_statuses(downloader.download(q.iter_records(args.pid, flatten=False)))
+        print(statuses)
+        sys.exit(1 if statuses.get('failed') else 0)
+
+    auditor = AttachmentAuditor(args.download_dir, args.workers)
+    statuses = count_statuses(auditor.audit(read_records(args.snapshot)))
+    print(statuses)
+    sys.exit(0 if set(statuses) <= {'ok'} else 1)
@@ -0,0 +1,338 @@
+import re, json, gzip, time, random, hashlib, argparse, threading
+from datetime import datetime, timezone
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+"""
+Local stand-in for the NOAA IR export API, used by run_benchmarks.py.
+
+Serves synthetic records at /fedora/export/view/collection/<pid>,
+honoring 'rows', 'start', 'from', 'until', 'fl' and 'sort' (by
+fgs.lastModifiedDate, 'asc' or 'desc') params, and their
+DS attachment files at /view/noaa/<pid>/<label> (with Range requests),
+with optional injected latency, errors and throttling.
+
+Usage:
+    python benchmarks/fake_server.py --records 100000 --port 8000 \
+        --latency 0.05 --error-rate 0.01
+"""
+
+
+collection_path = '/fedora/export/view/collection/'
+item_path = '/view/noaa/'
+
+# first fgs.lastModifiedDate of synthetic records, and span covered by all records
+base_time = datetime(2010, 1, 1, tzinfo=timezone.utc).timestamp()
+time_span = 15 * 365 * 86400
+
+resource_types = ['Text'] * 12 + ['Still image', 'Cartographic', 'Dataset', 'Moving image']
+topics = ['salmon', 'coral reef', 'hurricane', 'sea level', 'fisheries management',
+    'marine mammals', 'climate', 'tides', 'sea grant', 'satellite', 'ocean acidification',
+    'estuaries', 'weather forecasting', 'habitat', 'stock assessment', 'aquaculture']
+series = ['NOAA technical memorandum NMFS', 'NOAA technical report NOS',
+    'NOAA technical memorandum NWS', 'NOAA technical memorandum OAR',
+    'NOAA Atlas NESDIS', 'Sea Grant publication']
+corporate_names = ['United States. National Marine Fisheries Service',
+    'United States. National Weather Service', 'United States. National Ocean Service',
+    'United States. Office of Oceanic and Atmospheric Research',
+    'United States. National Environmental Satellite, Data, and Information Service',
+    'National Sea Grant College Program (U.S.)']
+words = ('the of and to in for on with by from at as data survey report analysis '
+    'coastal marine atmospheric observations model program management assessment '
+    'regional national annual status trends').split()
+
+
+def format_date(timestamp):
+    date = datetime.fromtimestamp(timestamp, timezone.utc)
+    # milliseconds are kept when records are less than a second apart
+    if date.microsecond:
+        return date.strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'
+    return date.strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+def parse_date(value):
+    return datetime.strptime(value, '%Y-%m-%dT%H:%M:%SZ').replace(
+        tzinfo=timezone.utc).timestamp()
+
+
+class SyntheticCorpus():
+    """
+    Deterministic synthetic IR records. Record i is generated on
+    demand from a random generator seeded with i, and its
+    fgs.lastModifiedDate grows with i, so date windows map to
+    index ranges. Records are step seconds apart, spread over 
+    time_span (at least a second apart) by default.
+    """
+
+    def __init__(self, records, seed=0, step=None):
+
+        self.records = records
+        self.seed = seed
+        self.step = step or max(time_span / max(records, 1), 1)
+
+
+    def modified(self, i):
+        return base_time + i * self.step
+
+
+    def index_range(self, from_date=None, until_date=None):
+        """
+        Returns:
+            (first, last + 1) indexes of records modified
+            between from_date and until_date (inclusive).
+        """
+
+        first, end = 0, self.records
+        if from_date is not None:
+            first = max(first, int(-(-(parse_date(from_date) - base_time) // self.step)))
+        if until_date is not None:
+            end = min(end, int((parse_date(until_date) - base_time) // self.step) + 1)
+        return first, max(first, end)
+
+
+    def doc(self, i):
+        """
+        Returns:
+            synthetic record i
+        """
+
+        rng = random.Random(self.seed * 1000003 + i)
+        pid = str(i + 1)
+        modified = self.modified(i)
+        created = modified - rng.randint(0, 3 * 365) * 86400
+        year = datetime.fromtimestamp(created, timezone.utc).year - rng.randint(0, 30)
+        subjects = rng.sample(topics, rng.randint(1, 4))
+        title = ' '.join(rng.choice(words) for _ in range(rng.randint(4, 12)))
+        title = f'{subjects[0].capitalize()} {title} {year}'
+        abstract = ' '.join(rng.choice(words + topics) for _ in range(rng.randint(30, 120)))
+
+        doc = {
+            'PID': pid,
+            'mods.title': title,
+            'mods.abstract': abstract,
+            'mods.type_of_resource': rng.choice(resource_types),
+            'mods.subject': subjects,
+            'mods.related_series': rng.sample(series, rng.randint(0, 2)),
+            'mods.sm_localcorpname': rng.sample(corporate_names, rng.randint(1, 3)),
+            'mods.ss_publishyear': str(year),
+            'mods.sm_digital_object_identifier':
+                [f'https://doi.org/10.25923/{pid}'] if rng.random() < 0.4 else [],
+            'dc.title': title,
+            'dc.type': 'Text',
+            'fgs.createdDate': format_date(created),
+            'fgs.lastModifiedDate': format_date(modified),
+            'fgs.state': 'Active',
+            'fgs.ownerId': 'fedoraAdmin'
+            }
+
+        for n in range(1, 2 + (rng.random() < 0.2) + (rng.random() < 0.05)):
+            label = f'noaa_{pid}_DS{n}.pdf'
+            body = attachment_body(label, rng.randint(1000, 20000))
+            doc.update({
+                f'DS{n}.label_txt_en': label,
+                f'DS{n}.mimetype_txt_en': 'application/pdf',
+                f'DS{n}.filesize_tl': len(body),
+                f'DS{n}.checksum_txt_en': hashlib.sha256(body).hexdigest()
+                })
+
+        return doc
+
+
+    def attachment(self, pid, label):
+        """
+        Returns:
+            content of a DS file, None if record pid has no such file
+        """
+
+        if not pid.isdigit() or not 0 < int(pid) <= self.records:
+            return None
+        doc = self.doc(int(pid) - 1)
+        for n in range(1, 4):
+            if doc.get(f'DS{n}.label_txt_en') == label:
+                return attachment_body(label, doc[f'DS{n}.filesize_tl'])
+        return None
+
+
+def attachment_body(label, size):
+    """
+    Content of a synthetic DS file: label repeated up to size bytes.
+    """
+
+    label = label.encode()
+    return (label * (size // len(label) + 1))[:size]
+
+
+class FakeRepositoryHandler(BaseHTTPRequestHandler):
+    """
+    Request handler of the fake export API. Settings are
+    attributes of the server (see make_server).
+    """
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+
+    def do_GET(self):
+
+        settings = self.server.settings
+        url = urlparse(self.path)
+        params = {key: values[-1] for key, values in parse_qs(url.query).items()}
+
+        if not url.path.startswith((collection_path, item_path)):
+            return self.send_body(404, b'not found')
+
+        # requests above max_concurrent are throttled
+        with self.server.lock:
+            self.server.active += 1
+            throttled = 0 < settings['max_concurrent'] < self.server.active
+        try:
+            if throttled:
+                return self.send_body(429, b'too many requests',
+                    headers={'Retry-After': str(settings['retry_after'])})
+            self.respond(url, params)
+        finally:
+            with self.server.lock:
+                self.server.active -= 1
+
+
+    def respond(self, url, params):
+
+        settings = self.server.settings
+        if settings['latency']:
+            time.sleep(settings['latency']
+                * (1 + settings['jitter'] * (2 * random.random() - 1)))
+
+        if random.random() < settings['error_rate']:
+            headers = None
+            if settings['retry_after']:
+                headers = {'Retry-After': str(settings['retry_after'])}
+            return self.send_body(settings['error_status'], b'injected error',
+                headers=headers)
+
+        corpus = self.server.corpus
+        if url.path.startswith(item_path):
+            return self.send_attachment(*url.path[len(item_path):].split('/', 1))
+
+        first, end = corpus.index_range(params.get('from'), params.get('until'))
+        start = int(params.get('start', 0))
+        rows = int(params.get('rows', 10))
+        fields = params['fl'].split(',') if 'fl' in params else None
+
+        # records are in fgs.lastModifiedDate order
+        indexes = range(first, end)
+        if params.get('sort', '').endswith(' desc'):
+            indexes = indexes[::-1]
+
+        docs = []
+        for i in indexes[start:start + rows]:
+            doc = corpus.doc(i)
+            if fields is not None:
+                doc = {field: doc[field] for field in fields if field in doc}
+            docs.append(doc)
+
+        body = json.dumps({
+            'responseHeader': {'status': 0, 'params': params},
+            'response': {'numFound': end - first, 'start': start, 'docs': docs}
+            }).encode('utf-8')
+        self.send_body(200, body, 'application/json')
+
+
+    def send_attachment(self, pid, label=''):
+
+        body = self.server.corpus.attachment(pid, label)
+        if body is None:
+            return self.send_body(404, b'not found')
+
+        # 'bytes=<start>-' and 'bytes=<start>-<end>' ranges
+        match = re.match(r'bytes=(\d+)-(\d*)$', self.headers.get('Range', ''))
+        if match is None:
+            return self.send_body(200, body, 'application/pdf', compress=False)
+
+        start = int(match.group(1))
+        end = min(int(match.group(2) or len(body) - 1), len(body) - 1)
+        if start >= len(body):
+            self.send_response(416)
+            self.send_header('Content-Range', f'bytes */{len(body)}')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.send_body(206, body[start:end + 1], 'application/pdf', compress=False,
+            headers={'Content-Range': f'bytes {start}-{end}/{len(body)}'})
+
+
+    def send_body(self, status, body, content_type='text/plain', compress=True,
+        headers=None):
+
+        gzipped = compress and 'gzip' in self.headers.get('Accept-Encoding', '')
+        if gzipped:
+            body = gzip.compress(body, 1)
+
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        if gzipped:
+            self.send_header('Content-Encoding', 'gzip')
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def make_server(records, port=0, latency=0, jitter=0, error_rate=0,
+    error_status=503, seed=0, max_concurrent=0, retry_after=0, step=None):
+    """
+    Create a fake export API server on localhost.
+    Call serve_forever to run it.
+
+    Parameters:
+        records: number of synthetic records
+        port: 0 picks a free port
+        latency: seconds added to every request
+        jitter: latency varies by +/- jitter (fraction of latency)
+        error_rate: fraction of requests answered with error_status
+        max_concurrent: requests above this number in progress at
+        once are answered 429. 0 for no limit.
+        retry_after: Retry-After seconds sent with 429 and injected 
+        errors. 0 to leave it out of errors.
+        step: seconds between the fgs.lastModifiedDate of records, 
+        e.g. 0.4 for sub-second dates. spread over 15 years if None.
+
+    Returns:
+        ThreadingHTTPServer. api url is
+        f'http://127.0.0.1:{server.server_port}{collection_path}'
+        and item url f'http://127.0.0.1:{server.server_port}{item_path}'
+    """
+
+    server = ThreadingHTTPServer(('127.0.0.1', port), FakeRepositoryHandler)
+    server.daemon_threads = True
+    server.corpus = SyntheticCorpus(records, seed, step)
+    server.settings = {'latency': latency, 'jitter': jitter,
+        'error_rate': error_rate, 'error_status': error_status,
+        'max_concurrent': max_concurrent, 'retry_after': retry_after}
+    server.lock = threading.Lock()
+    server.active = 0
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Fake NOAA IR export API')
+    parser.add_argument('--records', type=int, default=10000)
+    parser.add_argument('--port', type=int, default=0)
+    parser.add_argument('--latency', type=float, default=0)
+    parser.add_argument('--jitter', type=float, default=0)
+    parser.add_argument('--error-rate', type=float, default=0)
+    parser.add_argument('--error-status', type=int, default=503)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--max-concurrent', type=int, default=0)
+    parser.add_argument('--retry-after', type=float, default=0)
+    parser.add_argument('--step', type=float, default=None)
+    args = parser.parse_args()
+
+    server = make_server(args.records, args.port, args.latency, args.jitter,
+        args.error_rate, args.error_status, args.seed, args.max_concurrent,
+        args.retry_after, args.step)
+    # first line of output is read by run_benchmarks.py
+    print(f'http://127.0.0.1:{server.server_port}{collection_path}', flush=True)
+    server.serve_forever()
@@ -0,0 +1,317 @@
+import os, sys, json, time, inspect, argparse, platform, subprocess, tempfile, threading
+from datetime import datetime
+current_dir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parent_dir = os.path.dirname(current_dir)
+sys.path.insert(0, parent_dir)
+
+"""
+Offline benchmarks of api_query.py against a local fake export API
+(fake_server.py).
+
+Each case runs in its own process, so peak RSS is measured per case.
+Results (records/sec, or requests/sec and latency for cases that
+download no records, peak RSS, wall time) are saved to
+benchmarks/results/<label>.json and compared with a baseline results
+file when one is passed.
+
+Usage:
+    python benchmarks/run_benchmarks.py --sizes 10000 100000 1000000
+    python benchmarks/run_benchmarks.py --baseline benchmarks/results/v1.json
+"""
+
+from api_query import RepositoryQuery, get_row_total, iterate_rows, concat_json
+
+
+fields = ['PID', 'mods.title', 'mods.type_of_resource',
+    'fgs.createdDate', 'mods.sm_digital_object_identifier',
+    'mods.related_series']
+
+
+def make_query(api_url, workers, **kwargs):
+    q = RepositoryQuery(fields, max_workers=workers, **kwargs)
+    q.api_url = api_url
+    return q
+
+
+def case_get_row_total(api_url, size, workers, tmp_dir):
+    requests = 20
+    for _ in range(requests):
+        get_row_total(api_url, 'noaa', None)
+    return requests
+
+
+def case_iterate_rows(api_url, size, workers, tmp_dir):
+    # urls of size rows are built 100 times
+    calls = 100
+    for _ in range(calls):
+        iterate_rows(api_url, 'noaa', size, None)
+    return size * calls
+
+
+def case_concat_json(api_url, size, workers, tmp_dir):
+    urls = iterate_rows(api_url, 'noaa', size, None)
+    return len(concat_json(urls))
+
+
+def case_concat_json_parallel(api_url, size, workers, tmp_dir):
+    urls = iterate_rows(api_url, 'noaa', size, None)
+    return len(concat_json(urls, workers))
+
+
+def case_filter_on_fields(api_url, size, workers, tmp_dir):
+    q = make_query(api_url, workers)
+    q.get_all_items()
+    # only filtering is timed
+    started = time.perf_counter()
+    q.filter_on_fields()
+    return len(q.collection_data), time.perf_counter() - started
+
+
+def case_sharded_subsecond(api_url, size, workers, tmp_dir):
+    """
+    Regression check of shard_rows: a server of its own serves
+    records 0.4 seconds apart, so windows end and start inside
+    seconds shared by several records. Fails unless every record
+    is harvested once.
+    """
+
+    from fake_server import make_server, collection_path
+    server = make_server(size, step=0.4)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        q = make_query(f'http://127.0.0.1:{server.server_port}{collection_path}',
+            workers, shard_rows=max(size // 10, 1), page_size=max(size // 20, 1))
+        pids = [record['PID'] for page in q.iter_collection_pages('noaa') 
+            for record in page]
+    finally:
+        server.shutdown()
+    if len(pids) != size or len(set(pids)) != size:
+        raise Exception(f'{len(set(pids))} records harvested once, '
+            f'{len(pids) - len(set(pids))} twice, of {size}')
+    return size
+
+
+def export_case(filetype, **kwargs):
+    def case(api_url, size, workers, tmp_dir):
+        q = make_query(api_url, workers, **kwargs)
+        q.export_all_items(filetype, tmp_dir, 'bench')
+        return size
+    return case
+
+
+cases = {
+    'get_row_total': case_get_row_total,
+    'iterate_rows': case_iterate_rows,
+    'concat_json': case_concat_json,
+    'concat_json_parallel': case_concat_json_parallel,
+    'filter_on_fields': case_filter_on_fields,
+    'export_csv': export_case('csv'),
+    'export_json': export_case('json'),
+    'export_ndjson_gz': export_case('ndjson.gz'),
+    'export_parquet': export_case('parquet'),
+    'export_csv_stream_parse': export_case('csv', stream_parse=True),
+    'export_csv_adaptive': export_case('csv', adaptive_paging=True),
+    'sharded_subsecond': case_sharded_subsecond,
+    }
+
+# unit counted by cases that don't download records. 'records' if not listed
+case_units = {
+    'get_row_total': 'requests'
+    }
+
+
+def rate_key(case):
+    """
+    Returns:
+        result key of the rate of a case, e.g. 'records_per_sec'
+    """
+    return f"{case_units.get(case, 'records')}_per_sec"
+
+
+def peak_rss_mb():
+    """
+    Peak resident set size of this process, in MB. None
+    where the resource module is not available (Windows).
+    """
+
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes on Linux
+    return peak / 1024 ** 2 if sys.platform == 'darwin' else peak / 1024
+
+
+def run_case(case, api_url, size, workers):
+    """
+    Run a single case in this process.
+
+    Returns:
+        result dict
+    """
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        started = time.perf_counter()
+        result = cases[case](api_url, size, workers, tmp_dir)
+        wall = time.perf_counter() - started
+
+    # cases timing only part of their work return (count, seconds)
+    if isinstance(result, tuple):
+        count, wall = result
+    else:
+        count = result
+
+    unit = case_units.get(case, 'records')
+    result = {
+        'case': case,
+        'size': size,
+        unit: count,
+        'wall_seconds': round(wall, 4),
+        rate_key(case): round(count / wall, 1) if wall else None,
+        'peak_rss_mb': peak_rss_mb()
+        }
+    if unit == 'requests':
+        result['latency_ms'] = round(wall / count * 1000, 2) if count else None
+    return result
+
+
+def run_in_child(case, api_url, size, workers):
+    """
+    Run a case in a new process.
+
+    Returns:
+        result dict, with 'error' if the case failed.
+    """
+
+    p = subprocess.run([sys.executable, os.path.abspath(__file__),
+        '--child', case, '--url', api_url, '--sizes', str(size),
+        '--workers', str(workers)],
+        capture_output=True, text=True)
+
+    if p.returncode != 0:
+        return {'case': case, 'size': size, 'error': p.stderr.strip().splitlines()[-1:]}
+    return json.loads(p.stdout.strip().splitlines()[-1])
+
+
+def start_server(size, args):
+    """
+    Start fake_server.py in a new process.
+
+    Returns:
+        (process, api url)
+    """
+
+    server = subprocess.Popen([sys.executable,
+        os.path.join(current_dir, 'fake_server.py'),
+        '--records', str(size), '--latency', str(args.latency),
+        '--jitter', str(args.jitter), '--error-rate', str(args.error_rate)],
+        stdout=subprocess.PIPE, text=True)
+    api_url = server.stdout.readline().strip()
+    return server, api_url
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=parent_dir, capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return ''
+
+
+def compare(results, baseline_file, threshold):
+    """
+    Print records/sec (requests/sec, see case_units) change 
+    of each case against a baseline results file.
+
+    Returns:
+        list of (case, size) slower than the baseline by more
+        than threshold (fraction).
+    """
+
+    with open(baseline_file) as f:
+        baseline = {(r['case'], r['size']): r for r in json.load(f)['results']}
+
+    regressions = []
+    print('')
+    print(f"{'case':<26}{'size':>9}{'baseline/s':>14}{'current/s':>14}{'change':>9}")
+    for result in results:
+        before = baseline.get((result['case'], result['size']))
+        key = rate_key(result['case'])
+        if before is None or not before.get(key) or not result.get(key):
+            continue
+        change = result[key] / before[key] - 1
+        flag = ''
+        if change < -threshold:
+            flag = '  REGRESSION'
+            regressions.append((result['case'], result['size']))
+        print(f"{result['case']:<26}{result['size']:>9}{before[key]:>14}"
+            f"{result[key]:>14}{change:>9.1%}{flag}")
+
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='api_query.py offline benchmarks')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000, 1000000])
+    parser.add_argument('--cases', nargs='+', default=list(cases), choices=list(cases))
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--latency', type=float, default=0)
+    parser.add_argument('--jitter', type=float, default=0)
+    parser.add_argument('--error-rate', type=float, default=0)
+    parser.add_argument('--label', default=None,
+        help='results file name. git commit by default')
+    parser.add_argument('--results-dir', default=os.path.join(current_dir, 'results'))
+    parser.add_argument('--baseline', default=None, help='results file to compare with')
+    parser.add_argument('--threshold', type=float, default=0.1,
+        help='slowdown reported as a regression. 0.1 is 10%%')
+    parser.add_argument('--child', default=None, help=argparse.SUPPRESS)
+    parser.add_argument('--url', default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(run_case(args.child, args.url, args.sizes[0], args.workers)))
+        sys.exit(0)
+
+    results = []
+    for size in args.sizes:
+        server, api_url = start_server(size, args)
+        try:
+            for case in args.cases:
+                result = run_in_child(case, api_url, size, args.workers)
+                results.append(result)
+                if 'error' in result:
+                    print(f"{case:<26}{size:>9}  failed: {result['error']}")
+                elif case_units.get(case) == 'requests':
+                    print(f"{case:<26}{size:>9}{result['requests_per_sec']:>14} req/s"
+                        f"{result['wall_seconds']:>10} s{result['latency_ms']:>10} ms/req")
+                else:
+                    print(f"{case:<26}{size:>9}{result['records_per_sec']:>14} rec/s"
+                        f"{result['wall_seconds']:>10} s{result['peak_rss_mb'] or 0:>10.1f} MB")
+        finally:
+            server.terminate()
+            server.wait()
+
+    label = args.label or git_commit() or datetime.now().strftime('%Y_%m_%d_%H%M%S')
+    if not os.path.exists(args.results_dir):
+        os.makedirs(args.results_dir)
+    results_file = os.path.join(args.results_dir, f'{label}.json')
+    with open(results_file, 'w') as f:
+        json.dump({
+            'label': label,
+            'commit': git_commit(),
+            'date': datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'workers': args.workers,
+            'latency': args.latency,
+            'error_rate': args.error_rate,
+            'results': results
+            }, f, indent=4)
+    print('')
+    print(results_file)
+
+    if args.baseline:
+        regressions = compare(results, args.baseline, args.threshold)
+        if regressions:
+            sys.exit(1)
@@ -0,0 +1,332 @@
+import json, sqlite3
+from fnmatch import fnmatch
+from api_query import field_iterator, is_field_pattern
+
+"""
+Class used to keep a local SQLite mirror of IR records:
+- RepositoryMirror
+
+"""
+
+
+class RepositoryMirror():
+    """
+    Local SQLite mirror of NOAA Repository records.
+
+    Each record is stored once, keyed by PID, with its raw JSON and
+    one column per field (flattened the same way as
+    RepositoryQuery.filter_on_fields). Title, abstract and subject
+    fields are indexed with FTS5 for full-text search. The PIDs of
+    each collection pulled are kept, see set_members.
+
+    The mirror is a single database file and survives between processes.
+    Fields are column names, so wildcard fields (see FieldProjector) 
+    are not accepted.
+    """
+
+    # FTS5 columns and the raw API fields (fnmatch patterns) they are built from
+    text_fields = {
+        'title': ['mods.title', 'mods.title_*'],
+        'abstract': ['mods.abstract'],
+        'subjects': ['mods.*subject*', 'mods.*topic*', 'mods.*keyword*']
+        }
+
+    def __init__(self, db_path, fields):
+
+        patterns = [field for field in fields if is_field_pattern(field)]
+        if patterns:
+            raise Exception(f'wildcard fields {patterns} cannot be mirrored. '
+                'List the fields they match instead')
+
+        self.db_path = db_path
+        self.fields = list(fields)
+        self.conn = sqlite3.connect(db_path)
+        self.conn.row_factory = sqlite3.Row
+
+        self.create_tables()
+        self.ensure_columns()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+    def close(self):
+        self.conn.close()
+
+
+    def create_tables(self):
+        """
+        Create records and full-text tables if they don't exist.
+        """
+
+        fts_columns = ', '.join(self.text_fields)
+        with self.conn:
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS records '
+                '(pid_key TEXT PRIMARY KEY, raw_json TEXT NOT NULL)')
+            self.conn.execute(
+                f'CREATE VIRTUAL TABLE IF NOT EXISTS records_fts '
+                f'USING fts5({fts_columns})')
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS members '
+                '(collection TEXT NOT NULL, pid_key TEXT NOT NULL, '
+                'PRIMARY KEY (collection, pid_key))')
+
+
+    def columns(self):
+        """
+        Returns:
+            list of field columns of records table
+        """
+
+        rows = self.conn.execute('PRAGMA table_info(records)').fetchall()
+        return [row['name'] for row in rows if row['name'] not in ('pid_key', 'raw_json')]
+
+
+    def ensure_columns(self):
+        """
+        Add a column for every field not yet mirrored, filled
+        from the raw JSON of records already stored.
+        """
+
+        new_fields = [field for field in self.fields if field not in self.columns()]
+        if not new_fields:
+            return
+
+        with self.conn:
+            for field in new_fields:
+                self.conn.execute(
+                    f'ALTER TABLE records ADD COLUMN {quote(field)} TEXT')
+
+            rows = self.conn.execute('SELECT pid_key, raw_json FROM records').fetchall()
+            for row in rows:
+                record = field_iterator(json.loads(row['raw_json']), new_fields)
+                assignments = ', '.join(f'{quote(field)} = ?' for field in new_fields)
+                self.conn.execute(
+                    f'UPDATE records SET {assignments} WHERE pid_key = ?',
+                    [record[field] for field in new_fields] + [row['pid_key']])
+
+
+    def upsert(self, docs):
+        """
+        Insert IR documents into the mirror, replacing records
+        already present with the same PID.
+
+        Parameters:
+            docs: list (or iterable) of raw IR documents (dicts)
+
+        Returns:
+            number of documents written
+        """
+
+        columns = ['pid_key', 'raw_json'] + self.fields
+        column_sql = ', '.join(quote(column) for column in columns)
+        placeholders = ', '.join('?' for _ in columns)
+
+        written = 0
+        with self.conn:
+            for doc in docs:
+                pid = str(doc['PID'])
+                record = field_iterator(doc, self.fields)
+
+                row = self.conn.execute(
+                    'SELECT rowid FROM records WHERE pid_key = ?', (pid,)).fetchone()
+                if row is not None:
+                    self.conn.execute(
+                        'DELETE FROM records_fts WHERE rowid = ?', (row['rowid'],))
+                    self.conn.execute(
+                        'DELETE FROM records WHERE rowid = ?', (row['rowid'],))
+
+                cursor = self.conn.execute(
+                    f'INSERT INTO records ({column_sql}) VALUES ({placeholders})',
+                    [pid, json.dumps(doc)] + [record[field] for field in self.fields])
+                self.conn.execute(
+                    f'INSERT INTO records_fts (rowid, {", ".join(self.text_fields)}) '
+                    f'VALUES (?, {", ".join("?" for _ in self.text_fields)})',
+                    [cursor.lastrowid] + text_values(doc, self.text_fields))
+                written += 1
+
+        return written
+
+
+    def count(self):
+        """
+        Returns:
+            number of records in the mirror
+        """
+        return self.conn.execute('SELECT COUNT(*) FROM records').fetchone()[0]
+
+
+    def set_members(self, collection, pids):
+        """
+        Replace the PIDs recorded as members of a collection.
+
+        Parameters:
+            collection: collection pid ('noaa' for every record).
+            pids: iterable of record PIDs.
+        """
+
+        with self.conn:
+            self.conn.execute(
+                'DELETE FROM members WHERE collection = ?', (str(collection),))
+            self.conn.executemany(
+                'INSERT OR IGNORE INTO members (collection, pid_key) VALUES (?, ?)',
+                ((str(collection), str(pid)) for pid in pids))
+
+
+    def members(self, collection):
+        """
+        Returns:
+            set of PIDs (strings) of a collection, as of its last
+            pull. Empty if the collection was never pulled.
+        """
+
+        rows = self.conn.execute(
+            'SELECT pid_key FROM members WHERE collection = ?', (str(collection),))
+        return {row['pid_key'] for row in rows}
+
+
+    def get(self, pid):
+        """
+        Get a record by PID.
+
+        Returns:
+            record dict of fields, None if PID is not mirrored.
+        """
+
+        row = self.conn.execute(
+            f'SELECT {self.select_sql()} FROM records WHERE pid_key = ?',
+            (str(pid),)).fetchone()
+        return None if row is None else dict(row)
+
+
+    def get_raw(self, pid):
+        """
+        Get the raw IR document of a PID.
+
+        Returns:
+            dict of every API field, None if PID is not mirrored.
+        """
+
+        row = self.conn.execute(
+            'SELECT raw_json FROM records WHERE pid_key = ?', (str(pid),)).fetchone()
+        return None if row is None else json.loads(row['raw_json'])
+
+
+    def iter_records(self):
+        """
+        Returns:
+            generator of every mirrored record (dict of fields)
+        """
+
+        cursor = self.conn.execute(
+            f'SELECT {self.select_sql()} FROM records ORDER BY rowid')
+        for row in cursor:
+            yield dict(row)
+
+
+    def search_field(self, field, search_value):
+        """
+        Case insensitive substring search on a field, same as
+        RepositoryQuery.search_field.
+
+        Returns:
+            list of dicts.
+        """
+
+        return self.search_fields({field: search_value})
+
+
+    def search_fields(self, criteria, match='all'):
+        """
+        Case insensitive substring search on several fields.
+
+        Parameters:
+            criteria: dict of field: search_value
+            match: 'all' if every criteria must match, 'any' if
+            at least one must.
+
+        Returns:
+            list of dicts.
+        """
+
+        for field in criteria:
+            if field not in self.fields:
+                raise Exception('field not present. Check your RepositoryQuery instance fields')
+
+        operator = {'all': ' AND ', 'any': ' OR '}[match]
+        where = operator.join(
+            f'instr(lower({quote(field)}), ?) > 0' for field in criteria)
+        values = [value.lower() for value in criteria.values()]
+
+        cursor = self.conn.execute(
+            f'SELECT {self.select_sql()} FROM records WHERE {where} ORDER BY rowid',
+            values)
+        return [dict(row) for row in cursor]
+
+
+    def search_text(self, query, limit=None):
+        """
+        Full-text search on title, abstract and subjects.
+
+        Parameters:
+            query: FTS5 query (e.g. 'salmon AND habitat',
+            'title:coral', 'fish*')
+            limit: max number of records returned
+
+        Returns:
+            list of dicts, best matches first.
+        """
+
+        sql = (f'SELECT {self.select_sql("r")} FROM records_fts '
+            'JOIN records r ON r.rowid = records_fts.rowid '
+            'WHERE records_fts MATCH ? ORDER BY rank')
+        params = [query]
+        if limit is not None:
+            sql += ' LIMIT ?'
+            params.append(limit)
+
+        return [dict(row) for row in self.conn.execute(sql, params)]
+
+
+    def select_sql(self, table=None):
+        """
+        Helper method. SELECT list of field columns.
+        """
+
+        prefix = f'{table}.' if table else ''
+        return ', '.join(f'{prefix}{quote(field)}' for field in self.fields)
+
+
+def quote(identifier):
+    """
+    Quote SQLite identifier. Field names contain dots.
+    """
+    return '"' + identifier.replace('"', '""') + '"'
+
+
+def text_values(doc, text_fields):
+    """
+    Helper function. Collects text of the API fields matching
+    each FTS column patterns.
+
+    Returns:
+        list of strings, one per FTS column
+    """
+
+    values = []
+    for patterns in text_fields.values():
+        parts = []
+        for key, value in doc.items():
+            if any(fnmatch(key, pattern) for pattern in patterns):
+                if isinstance(value, list):
+                    parts.extend(str(v) for v in value)
+                else:
+                    parts.append(str(value))
+        values.append(' '.join(parts))
+    return values
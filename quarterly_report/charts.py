@@ -1,86 +1,360 @@
-import sys, os
+import sys, os, json, hashlib, argparse
+from concurrent.futures import ProcessPoolExecutor
+import matplotlib
+matplotlib.use('Agg')
 import matplotlib.pyplot as plt
 import pandas as pd
 from matplotlib import rcParams
 rcParams.update({'figure.autolayout': True})
 
+"""
+Builds the frequency tables and charts of the quarterly report
+from a usage report (CSV or Parquet).
+
+Every table and chart is fingerprinted in a manifest kept in the
+output directory. Tables are only computed again when the input
+file changes, and charts only rendered again when their table or
+title changes. Charts are rendered in parallel worker processes.
+
+Tables written by FacetAggregator.write_tables (api_query.py) use the
+same file names and columns. check_tables verifies a directory of
+tables can be charted.
+
+Usage:
+    python charts.py usage_report.csv 2024Q3
+    python charts.py usage_report.csv 2024Q3 --counts 'Document Type' Series \
+        --views 'Document Type' --workers 4
+    python charts.py --check data 2024Q3 --counts 'Document Type' --views 'Document Type'
+"""
+
+
+manifest_fname = 'report_manifest.json'
+
+# bump when table computations change, so cached tables are rebuilt
+table_version = 1
+
+count_title = 'Total Count to Date (as of FY{qt_info})'
+views_title = 'Total Views to Date (as of FY{qt_info})'
+
+
+def read_input(input_file, columns):
+    """
+    Read report input, loading only the columns needed.
+    """
+
+    if input_file.endswith('.parquet'):
+        return pd.read_parquet(input_file, columns=columns)
+    return pd.read_csv(input_file, usecols=columns)
+
 
 def reformat_column(column):
 
     return column.replace(' ','_').lower()
 
-def get_count(column):
+
+def get_count(df, column):
     """
     Get count of column passed.
 
     Returns:
-        CSV of frequency table and
-        matplotlib plot
+        DataFrame frequency table (column, Count),
+        most frequent first.
+    """
+
+    return df[column].value_counts() \
+        .rename_axis(column).reset_index(name='Count')
+
+
+def get_views(df, column):
+    """
+    Get total views of each value of column passed.
 
+    Returns:
+        DataFrame of Views indexed by column,
+        fewest views first.
     """
 
-    # document type counts
-    counts = df[column].value_counts() \
-        .to_frame().reset_index().rename(columns={
-        'index': column, column:'Count'})
+    total_views = df.groupby(column) \
+        [['Views']].sum()
+
+    return total_views.sort_values(
+        by='Views')
 
-    r_column = reformat_column(column)
-    counts.to_csv(os.path.join('data',
-        f'{r_column}_{qt_info}_doc_counts.csv'),
-        index=False
-        )
 
-    #plot document type counts
+def load_table(table_path, kind, column):
+    """
+    Read a count or views table, checking it has the
+    columns its chart is plotted from.
+
+    Returns:
+        DataFrame
+    """
+
+    table = pd.read_csv(table_path)
+    expected = [column, 'Count' if kind == 'count' else 'Views']
+    if list(table.columns) != expected:
+        raise Exception(f'{table_path}: columns {list(table.columns)}, expected {expected}')
+    return table
+
+
+def check_tables(output_dir, qt_info, counts=('Document Type', 'Published Year'),
+    views=('Document Type', 'Published Year')):
+    """
+    Check the tables of a report can be charted, e.g. tables
+    written by FacetAggregator.write_tables.
+
+    Returns:
+        dict of table path: error message, empty if every table loads
+    """
+
+    errors = {}
+    for spec in report_specs(counts, views, qt_info, output_dir):
+        if not os.path.exists(spec['table']):
+            errors[spec['table']] = 'missing'
+            continue
+        try:
+            load_table(spec['table'], spec['kind'], spec['column'])
+        except Exception as e:
+            errors[spec['table']] = str(e)
+    return errors
+
+
+def render_count(table_path, column, title, png_path):
+    """
+    Plot a count table. Runs in worker processes.
+    """
+
+    counts = load_table(table_path, 'count', column)
+
+    fig, ax = plt.subplots()
     counts.plot.barh(
         x=column,
         y='Count',
-        title= f'Total Count to Date (as of FY{qt_info})',
-        legend=False
+        title=title,
+        legend=False,
+        ax=ax
         ).invert_yaxis()
 
-    plt.savefig(
-        os.path.join('data',
-        f'{r_column}_{qt_info}_doc_counts.png'),
-        dpi=300)
+    fig.savefig(png_path, dpi=300)
+    plt.close(fig)
+    return png_path
 
 
-def get_views(column):
-
-    # total download and views
-    total_views = df.groupby(column) \
-        [['Views']].sum()
-
-    total_views = total_views.sort_values(
-        by='Views')
+def render_views(table_path, column, title, png_path):
+    """
+    Plot a views table. Runs in worker processes.
+    """
 
-    # print out CSV
-    r_column = reformat_column(column)
-    total_views.to_csv(os.path.join('data',
-        f'{r_column}_{qt_info}_view_to_date.csv'),
-        )
+    total_views = load_table(table_path, 'views', column).set_index(column)
 
-    # print chart
+    fig, ax = plt.subplots()
     total_views.plot.barh(
         rot=0,
-        title= f'Total Views to Date (as of FY{qt_info})',
-        legend=False
+        title=title,
+        legend=False,
+        ax=ax
         )
 
-    plt.savefig(
-        os.path.join('data',
-        f'{r_column}_{qt_info}-view_to_date.png'),
-        dpi=300)
+    fig.savefig(png_path, dpi=300)
+    plt.close(fig)
+    return png_path
 
 
-if __name__ == "__main__":
+# kind: (table function, renderer, csv file suffix, png file suffix, title)
+reports = {
+    'count': (get_count, render_count, '_doc_counts.csv', '_doc_counts.png', count_title),
+    'views': (get_views, render_views, '_view_to_date.csv', '-view_to_date.png', views_title)
+    }
+
+
+def report_specs(counts, views, qt_info, output_dir, titles=None):
+    """
+    Tables and charts of the report.
+
+    Parameters:
+        counts: columns with a count table and chart
+        views: columns with a total views table and chart
+        titles: dict of kind: title template, formatted with qt_info
+
+    Returns:
+        list of dicts (kind, column, table, png, title)
+    """
+
+    titles = dict(titles or {})
+    specs = []
+    for kind, columns in (('count', counts), ('views', views)):
+        _, _, table_suffix, png_suffix, title = reports[kind]
+        title = titles.get(kind, title)
+        for column in columns:
+            name = f'{reformat_column(column)}_{qt_info}'
+            specs.append({
+                'kind': kind,
+                'column': column,
+                'table': os.path.join(output_dir, f'{name}{table_suffix}'),
+                'png': os.path.join(output_dir, f'{name}{png_suffix}'),
+                'title': title.format(qt_info=qt_info)
+                })
+    return specs
+
+
+def fingerprint(*parts):
+    """
+    sha256 of strings
+    """
+
+    h = hashlib.sha256()
+    for part in parts:
+        h.update(str(part).encode('utf-8'))
+        h.update(b'\0')
+    return h.hexdigest()
+
+
+def file_fingerprint(file_path, cached=None):
+    """
+    sha256 of a file content. Reuses cached (size, mtime_ns, digest)
+    when the file size and modification time are unchanged.
+
+    Returns:
+        [size, mtime_ns, digest]
+    """
+
+    stat = os.stat(file_path)
+    if cached is not None and cached[:2] == [stat.st_size, stat.st_mtime_ns]:
+        return cached
+
+    h = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 ** 2), b''):
+            h.update(chunk)
+    return [stat.st_size, stat.st_mtime_ns, h.hexdigest()]
+
 
-    input_file = sys.argv[1]
-    qt_info = sys.argv[2]
+def read_manifest(output_dir):
+    path = os.path.join(output_dir, manifest_fname)
+    if not os.path.exists(path):
+        return {'inputs': {}, 'tables': {}, 'charts': {}}
+    with open(path) as f:
+        return json.load(f)
+
+
+def write_manifest(manifest, output_dir):
+    path = os.path.join(output_dir, manifest_fname)
+    with open(f'{path}.tmp', 'w') as f:
+        json.dump(manifest, f, indent=4)
+    os.replace(f'{path}.tmp', path)
+
+
+def build_report(input_file, qt_info, counts=('Document Type', 'Published Year'),
+    views=('Document Type', 'Published Year'), output_dir='data',
+    titles=None, max_workers=None, force=False):
+    """
+    Build the tables and charts of the report, skipping those
+    whose input is unchanged since the last build.
+
+    The input is read once, with only the columns of tables to
+    compute. Charts are rendered in max_workers processes.
+
+    Parameters:
+        input_file: usage report, CSV or Parquet
+        qt_info: quarter, e.g. '2024Q3'
+        counts: columns with a count table and chart
+        views: columns with a total views table and chart
+        output_dir: directory of tables, charts and manifest
+        titles: dict of kind ('count', 'views'): title template
+        max_workers: rendering processes. number of CPUs by default
+        force: rebuild everything
+
+    Returns:
+        dict of 'tables' and 'charts': lists of paths built
+    """
+
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+
+    manifest = {'inputs': {}, 'tables': {}, 'charts': {}}
+    if not force:
+        manifest = read_manifest(output_dir)
+
+    input_key = os.path.abspath(input_file)
+    manifest['inputs'][input_key] = file_fingerprint(input_file,
+        manifest['inputs'].get(input_key))
+    input_digest = manifest['inputs'][input_key][2]
+
+    specs = report_specs(counts, views, qt_info, output_dir, titles)
+
+    # tables
+    stale = []
+    for spec in specs:
+        spec['key'] = fingerprint(table_version, input_digest, spec['kind'], spec['column'])
+        entry = manifest['tables'].get(spec['table'])
+        if (entry is None or entry['key'] != spec['key']
+            or not os.path.exists(spec['table'])):
+            stale.append(spec)
+
+    if stale:
+        columns = sorted({spec['column'] for spec in stale}
+            | ({'Views'} if any(spec['kind'] == 'views' for spec in stale) else set()))
+        df = read_input(input_file, columns)
+        for spec in stale:
+            table = reports[spec['kind']][0](df, spec['column'])
+            table.to_csv(spec['table'], index=(spec['kind'] == 'views'))
+
+    for spec in specs:
+        if spec in stale or spec['table'] not in manifest['tables']:
+            manifest['tables'][spec['table']] = {'key': spec['key'],
+                'digest': file_fingerprint(spec['table'])[2]}
+
+    # charts
+    to_render = []
+    for spec in specs:
+        key = fingerprint(manifest['tables'][spec['table']]['digest'],
+            spec['kind'], spec['column'], spec['title'])
+        entry = manifest['charts'].get(spec['png'])
+        if entry is None or entry['key'] != key or not os.path.exists(spec['png']):
+            to_render.append((spec, key))
+
+    if to_render:
+        with ProcessPoolExecutor(max_workers) as executor:
+            futures = [(spec, key, executor.submit(reports[spec['kind']][1],
+                spec['table'], spec['column'], spec['title'], spec['png']))
+                for spec, key in to_render]
+            for spec, key, future in futures:
+                future.result()
+                manifest['charts'][spec['png']] = {'key': key}
+
+    write_manifest(manifest, output_dir)
+
+    return {
+        'tables': [spec['table'] for spec in stale],
+        'charts': [spec['png'] for spec, _ in to_render]
+        }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Quarterly report tables and charts')
+    parser.add_argument('input_file', help='usage report, CSV or Parquet. '
+        'with --check, directory of tables')
+    parser.add_argument('qt_info', help='quarter, e.g. 2024Q3')
+    parser.add_argument('--counts', nargs='*', default=['Document Type', 'Published Year'],
+        help='columns with a count chart')
+    parser.add_argument('--views', nargs='*', default=['Document Type', 'Published Year'],
+        help='columns with a total views chart')
+    parser.add_argument('--count-title', default=count_title)
+    parser.add_argument('--views-title', default=views_title)
+    parser.add_argument('--output', default='data')
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--force', action='store_true', help='ignore cached tables and charts')
+    parser.add_argument('--check', action='store_true', 
+        help='only check the tables of a directory can be charted')
+    args = parser.parse_args()
 
-    df = pd.read_csv(input_file)
-    
-    get_count('Document Type')
-    get_count('Published Year')
+    if args.check:
+        errors = check_tables(args.input_file, args.qt_info, args.counts, args.views)
+        for table_path, error in errors.items():
+            print(f'{table_path}: {error}')
+        sys.exit(1 if errors else 0)
 
-    get_views('Document Type')
-    get_views('Published Year')
+    built = build_report(args.input_file, args.qt_info, args.counts, args.views,
+        args.output, {'count': args.count_title, 'views': args.views_title},
+        args.workers, args.force)
+    print(f"{len(built['tables'])} tables and {len(built['charts'])} charts built")
@@ -1,5 +1,5 @@
 from datetime import datetime
-import os,sys,inspect
+import os,sys,csv,time,inspect
 current_dir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
 parent_dir = os.path.dirname(current_dir)
 sys.path.insert(0, parent_dir)
@@ -7,53 +7,170 @@ sys.path.insert(0, parent_dir)
 """
 Script is used to generate report and charts for an IR collection
 on a quarterly basis.
+
+IR records are read from a local snapshot of the collection,
+indexed by PID: a Parquet export or a RepositoryMirror database
+('.db'). A missing Parquet snapshot is exported from the API, and
+one older than max_snapshot_age days can be refreshed. A mirror may
+hold records of several collections, so its lookups are restricted
+to the members of the collection stored by its last pull (see
+RepositoryQuery.mirror_collection). The CDC usage report is then streamed row by row against the index, so the
+report doesn't hold both sides of a merge in memory.
 """
 
 # import custom scripts
-from stats import StatsData
-from api_query import RepositoryQuery
+from api_query import RepositoryQuery, read_records
+from mirror import RepositoryMirror
 from article_monthly_update import transform_cdc_report
 
-# create DataFrames
-ir_collection_num = input('Select IR collection (PID): ')
-print(type(ir_collection_num))
-
-q = RepositoryQuery()
-q.fields = [ 'PID', 'mods.title', 'mods.type_of_resource',
-'mods.related_series', 'mods.sm_digital_object_identifier']
-
-s = StatsData('mods.sm_localcorpname', pid_info=q.pid_dict)
-ir_df = s.get_df(ir_collection_num)
-print(ir_df)
-
-# convert to to allow for merging on pid
-ir_df['PID'] = ir_df['PID'].astype('int')
-ir_df['mods.related_series'] = ir_df['mods.related_series'].str.join('')
-ir_df['mods.type_of_resource'] = ir_df['mods.type_of_resource'].str.join('')
-
-ir_df['mods.sm_digital_object_identifier'] \
-    = ir_df['mods.sm_digital_object_identifier'].str.join('')
-
-current_cdc_file = input('Path to current CDC Report: ')
-cdc_df = transform_cdc_report(current_cdc_file)
-
-merged_data = ir_df.merge(
-    cdc_df,
-    left_on='PID',
-    right_on='PID'
-    )
-
-# reindex
-merged_data = merged_data[['mods.title', 'PID', 'DOI','mods.type_of_resource',
-    'Stacks Downloads', 'Stacks Views', 'Date Added', 'Months in IR',
-    'Avg Downloads per Month', 'Avg Views per Month', 'mods.ss_publishyear',
-    'mods.related_series']]
-
-# rename columns
-merged_data = merged_data.rename(columns={'mods.title':'Title', 'PID': 'Link',
-    'mods.type_of_resource': 'Document Type', 'Stacks Downloads': 'Downloads',
-    'Stacks Views': 'Views', 'mods.ss_publishyear': 'Published Year',
-    'mods.related_series':'Series'})
-
-today = datetime.now().strftime('%m-%d-%Y')
-merged_data.to_csv(f'usage_report-{today}.csv')
+
+fields = ['PID', 'mods.title', 'mods.type_of_resource',
+    'mods.related_series', 'mods.sm_digital_object_identifier',
+    'mods.ss_publishyear']
+
+# (report column, source): IR field of the snapshot, or CDC report column
+report_columns = [
+    ('Title', 'mods.title'),
+    ('Link', 'PID'),
+    ('DOI', 'DOI'),
+    ('Document Type', 'mods.type_of_resource'),
+    ('Downloads', 'Stacks Downloads'),
+    ('Views', 'Stacks Views'),
+    ('Date Added', 'Date Added'),
+    ('Months in IR', 'Months in IR'),
+    ('Avg Downloads per Month', 'Avg Downloads per Month'),
+    ('Avg Views per Month', 'Avg Views per Month'),
+    ('Published Year', 'mods.ss_publishyear'),
+    ('Series', 'mods.related_series')
+    ]
+
+# snapshots older than this (days) are offered a refresh
+max_snapshot_age = 7
+
+
+def export_snapshot(pid, snapshot_path):
+    """
+    Export collection pid to a Parquet snapshot.
+    """
+
+    q = RepositoryQuery(fields, max_workers=4)
+    export_path, fname = os.path.split(snapshot_path)
+    q.export_single_collection(pid, 'parquet', export_path or '.',
+        fname[:-len('.parquet')])
+
+
+def snapshot_age(snapshot_path):
+    """
+    Returns:
+        days since the snapshot was written
+    """
+
+    return (time.time() - os.path.getmtime(snapshot_path)) / 86400
+
+
+def text(value):
+    """
+    Snapshot value as report text. Parquet keeps
+    multivalued fields as lists.
+    """
+
+    if value is None:
+        return ''
+    if isinstance(value, list):
+        return '~'.join(str(v) for v in value)
+    return str(value)
+
+
+def snapshot_index(snapshot_path, pid):
+    """
+    PID-keyed index of a snapshot of collection pid.
+
+    Returns:
+        function returning the record (dict of fields) of
+        a PID, None if the PID isn't in the snapshot or
+        isn't a member of the collection.
+    """
+
+    if snapshot_path.endswith('.db'):
+        mirror = RepositoryMirror(snapshot_path, fields)
+        # mirror may hold other collections
+        members = {int(record_pid) for record_pid in mirror.members(pid)}
+        if not members:
+            raise Exception(f'{snapshot_path} holds no members of collection {pid}. '
+                'Pull it with RepositoryQuery.mirror_collection')
+        return lambda record_pid: (mirror.get(record_pid) 
+            if int(record_pid) in members else None)
+
+    # only report fields are loaded, see read_records
+    index = {}
+    for record in read_records(snapshot_path, columns=fields):
+        index[int(record['PID'])] = {field: text(record.get(field)) for field in fields}
+    return lambda pid: index.get(int(pid))
+
+
+def iter_cdc_rows(cdc_df):
+    """
+    Rows of the CDC report as dicts.
+    """
+
+    columns = list(cdc_df.columns)
+    for values in cdc_df.itertuples(index=False, name=None):
+        yield dict(zip(columns, values))
+
+
+def write_usage_report(lookup, cdc_rows, file_path):
+    """
+    Join CDC report rows with snapshot records on PID,
+    writing each matching row as it is read. CDC rows
+    whose PID isn't in the snapshot are left out.
+
+    Returns:
+        number of rows written
+    """
+
+    written = 0
+    with open(file_path, 'w', newline='', encoding='utf-8') as fh:
+        writer = csv.writer(fh)
+        writer.writerow([''] + [column for column, _ in report_columns])
+
+        for row in cdc_rows:
+            record = lookup(row['PID'])
+            if record is None:
+                continue
+            values = [record[source] if source in record else row[source]
+                for _, source in report_columns]
+            writer.writerow([written] + values)
+            written += 1
+
+    return written
+
+
+if __name__ == "__main__":
+    ir_collection_num = input('Select IR collection (PID): ')
+
+    snapshot_path = input(f'Path to collection snapshot (.parquet or mirror .db) '
+        f'[snapshot_{ir_collection_num}.parquet]: ') or f'snapshot_{ir_collection_num}.parquet'
+    if not os.path.exists(snapshot_path):
+        if snapshot_path.endswith('.db'):
+            raise Exception(f'{snapshot_path} not found. Create it with RepositoryQuery.mirror_collection')
+        export_snapshot(ir_collection_num, snapshot_path)
+    else:
+        age = snapshot_age(snapshot_path)
+        if age > max_snapshot_age and snapshot_path.endswith('.db'):
+            print(f'Warning: {snapshot_path} is {age:.0f} days old. '
+                'Refresh it with RepositoryQuery.mirror_collection')
+        elif age > max_snapshot_age:
+            answer = input(f'{snapshot_path} is {age:.0f} days old. '
+                'Export it again from the API? [y/N]: ')
+            if answer.strip().lower() == 'y':
+                export_snapshot(ir_collection_num, snapshot_path)
+
+    lookup = snapshot_index(snapshot_path, ir_collection_num)
+
+    current_cdc_file = input('Path to current CDC Report: ')
+    cdc_df = transform_cdc_report(current_cdc_file)
+
+    today = datetime.now().strftime('%m-%d-%Y')
+    written = write_usage_report(lookup, iter_cdc_rows(cdc_df),
+        f'usage_report-{today}.csv')
+    print(f'{written} rows written to usage_report-{today}.csv')